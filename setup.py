@@ -50,9 +50,18 @@ setup(
             'openmvflash = stm32tool.entry.flash:main',
             'openmvdevice = stm32tool.entry.get_devices:main',
             'openmvview = stm32tool.entry.priview:main',
+            'openmvpool = stm32tool.openmvpool:main',
+            'openmvrecord = stm32tool.recorder:main',
+            'openmvserve = stm32tool.frameserver:main',
+            'openmvshm = stm32tool.shmring:main',
+            'openmvemu = stm32tool.openmvemu:main',
+            'openmvbench = stm32tool.openmvbench:main',
             'pydfu = stm32tool.entry.pydfu:main',
             'mkdfu = stm32tool.entry.dfu:main',
             'stm32isp = stm32tool.isp:main',
+            'stm32fleet = stm32tool.fleet:main',
+            'stm32ispemu = stm32tool.ispemu:main',
+            'stm32ispbench = stm32tool.ispbench:main',
         ],
     },
 )
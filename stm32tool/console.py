@@ -0,0 +1,140 @@
+import asyncio
+import threading
+import time
+from collections import deque
+
+MIN_INTERVAL = 0.005
+MAX_INTERVAL = 0.5
+TX_CHUNK = 0x1000
+
+
+class ScriptConsole(object):
+    # the printed output of the running script, polled on a thread.
+    # Every poll is a short control command, the scheduler puts it between
+    # two frame dumps. The poll interval doubles while the script prints
+    # nothing, up to max_interval, so an idle console leaves the link to
+    # the frame stream, and drops back to min_interval on output.
+    # Complete lines go to callback(line), lines() and the asyncio streams.
+    def __init__(self, cam, callback=None, min_interval=MIN_INTERVAL,
+                 max_interval=MAX_INTERVAL, keep=1000):
+        self.cam = cam
+        self.callback = callback
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.polls = 0
+        self.nbytes = 0
+        self.error = None
+        self._partial = b''
+        self._lines = deque(maxlen=keep)
+        self._streams = []
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        if self._partial:
+            self._line(self._partial)
+            self._partial = b''
+        with self._cond:
+            self._cond.notify_all()
+            streams, self._streams = self._streams, []
+        for loop, reader in streams:
+            loop.call_soon_threadsafe(reader.feed_eof)
+
+    @property
+    def running(self):
+        return self._thread is not None and not self._stop.is_set()
+
+    def poll(self):
+        # the output waiting on the camera, b'' when there is none
+        self.polls += 1
+        num = self.cam.tx_buf_len()
+        if not num:
+            return b''
+        data = self.cam.tx_buf(min(num, TX_CHUNK))
+        self.nbytes += len(data)
+        return data
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                data = self.poll()
+            except Exception as e:
+                self.error = str(e) or e.__class__.__name__
+                break
+            if data:
+                self._feed(data)
+                # more is waiting when a whole chunk came
+                self.interval = 0 if len(data) == TX_CHUNK else self.min_interval
+            else:
+                self.interval = min(max(self.interval * 2, self.min_interval), self.max_interval)
+            self._stop.wait(self.interval)
+        with self._cond:
+            self._cond.notify_all()
+
+    def _feed(self, data):
+        with self._cond:
+            streams = list(self._streams)
+        for loop, reader in streams:
+            loop.call_soon_threadsafe(reader.feed_data, data)
+        lines = (self._partial + data).split(b'\n')
+        self._partial = lines.pop()
+        for line in lines:
+            self._line(line)
+
+    def _line(self, line):
+        line = line.rstrip(b'\r').decode('utf-8', 'replace')
+        with self._cond:
+            self._lines.append(line)
+            self._cond.notify_all()
+        if self.callback:
+            self.callback(line)
+
+    def get(self, timeout=None):
+        # the next line, None on timeout or when the console stopped
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while not self._lines:
+                if not self.running:
+                    return None
+                remain = None if deadline is None else deadline - time.time()
+                if remain is not None and remain <= 0:
+                    return None
+                self._cond.wait(remain if remain is not None else 0.1)
+            return self._lines.popleft()
+
+    def lines(self, timeout=None):
+        while True:
+            line = self.get(timeout)
+            if line is None:
+                return
+            yield line
+
+    def __iter__(self):
+        return self.lines()
+
+    def stream(self, loop=None):
+        # an asyncio.StreamReader of the raw output from now on, call from
+        # the event loop: await reader.readline()
+        loop = loop or asyncio.get_running_loop()
+        reader = asyncio.StreamReader(loop=loop)
+        with self._cond:
+            self._streams.append((loop, reader))
+        return reader
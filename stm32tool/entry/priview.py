@@ -3,7 +3,10 @@ import argparse
 import os
 import time
 
-import stm32tool as openmv
+from stm32tool import openmv
+from stm32tool.console import ScriptConsole
+from stm32tool.grabber import FrameGrabber
+from stm32tool.recorder import Recorder, Replay
 
 from .data import hello_world
 
@@ -14,9 +17,10 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-f', '--file', help='script file')
     parser.add_argument('-o', '--out', default='image', help='capture image output dictory')
+    parser.add_argument('-r', '--replay', help='show a recording instead of the camera')
     args = parser.parse_args()
 
-    cam = openmv.OpenMV()
+    cam = Replay(args.replay, realtime=True, loop=True) if args.replay else openmv.OpenMV()
 
     if not cam.connect():
         exit()
@@ -37,9 +41,17 @@ def main():
     Clock.tick(100)
     frame_count = 1
     frame_size = None
+    grabber = FrameGrabber(cam)
+    grabber.start()
+    # print the output of the script
+    console = ScriptConsole(cam, callback=print)
+    console.start()
+    recorder = None
+    seq = 0
 
     while running:
-        fb = cam.fb_dump()
+        fb = grabber.latest() if grabber.seq != seq else None
+        seq = grabber.seq
         if fb != None:
             # create image from RGB888
             image = pygame.image.frombuffer(fb[2].flat[0:], (fb[0], fb[1]), 'RGB')
@@ -52,6 +64,8 @@ def main():
             frame_count += 1
             frame_size = fb[:2]
             Clock.tick(100)
+        else:
+            time.sleep(0.001)
 
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
@@ -66,7 +80,26 @@ def main():
                     file_name = os.path.join(dir_name, '{}x{}-{}_{}.png'.format(*frame_size, time.strftime("%H-%M-%S"), frame_count))
                     pygame.image.save(image, file_name)
                     print('save image: {}'.format(file_name))
+                elif event.key == pygame.K_r:
+                    # start or stop recording the undecoded frames
+                    if recorder is None:
+                        dir_name = os.path.abspath(args.out)
+                        if not os.path.exists(dir_name):
+                            os.makedirs(dir_name)
+                        file_name = os.path.join(dir_name, '{}.omv'.format(time.strftime("%Y%m%d-%H%M%S")))
+                        recorder = Recorder(file_name, {'fw_version': cam.fw_version})
+                        grabber.tap = recorder.add
+                        print('start recording: {}'.format(file_name))
+                    else:
+                        grabber.tap = None
+                        recorder.close()
+                        print('stop recording: {} frames, {} dropped'.format(recorder.frames, recorder.dropped))
+                        recorder = None
 
     pygame.quit()
+    console.stop()
+    grabber.stop()
+    if recorder:
+        recorder.close()
     cam.stop_script()
     cam.disconnect()
@@ -0,0 +1,153 @@
+# Two stage flashing: the ROM bootloader loads a small helper into SRAM and
+# starts it, then the helper takes large blocks at a higher baudrate.
+#
+# Helper protocol, 8N1 at the new baudrate, every request is a '<BII'
+# header (command, address or sector, length) and little endian words:
+#   SYNC  0x5A  -, -                    -> ACK
+#   WRITE 0x57  address, length + data + crc32(data)
+#                                       -> ACK when programmed, NACK on crc
+#   CRC   0x43  address, length         -> ACK + crc32 of the flash range
+#   ERASE 0x45  sector, -               -> ACK when erased
+#   GO    0x47  address, -              -> ACK, then jump
+import struct
+import time
+import zlib
+from collections import deque
+
+from .isp import ACK, NACK, IspError, LocalBar, check_acks
+
+FAST_SYNC = 0x5A
+FAST_WRITE = 0x57
+FAST_CRC = 0x43
+FAST_ERASE = 0x45
+FAST_GO = 0x47
+
+FAST_HEADER = struct.Struct('<BII')
+FAST_BLOCK = 0x4000
+FAST_BPS = 921600
+LOADER_ADDR = 0x20001000
+
+
+def crc32(data):
+    return zlib.crc32(data) & 0xFFFFFFFF
+
+
+class FastLoader(object):
+    def __init__(self, isp, loader, addr=LOADER_ADDR, block=FAST_BLOCK, window=2):
+        self.isp = isp
+        self.dev = isp.dev
+        self.loader = loader
+        self.addr = addr
+        self.block = block
+        # blocks sent before waiting for the first ack, the helper double
+        # buffers so it can receive one block while programming the other
+        self.window = window
+        self.nbytes = 0
+        self.elapsed = 0.0
+
+    def _request(self, cmd, arg=0, length=0, payload=b''):
+        self.dev.write(FAST_HEADER.pack(cmd, arg, length) + payload)
+
+    def _ack(self, info=''):
+        ack = self.dev.read(1)
+        if not ack:
+            raise IspError('can not get ack of the loader or timeout!')
+        check_acks(ack, info)
+
+    def start(self, bps=FAST_BPS):
+        # load the helper through the ROM bootloader and switch the port
+        self.isp.writebin(self.loader, self.addr, progress=False)
+        self.isp.go(self.addr)
+        time.sleep(0.05)
+        try:
+            self.dev.apply_settings({'baudrate': bps, 'parity': 'N'})
+        except Exception as e:
+            raise IspError('can not switch the port to {} bps: {}'.format(bps, e))
+        self.dev.reset_input_buffer()
+        for _ in range(self.isp.retries + 1):
+            self._request(FAST_SYNC)
+            if self.dev.read(1) == bytes([ACK]):
+                return
+        raise IspError('no answer of the loader')
+
+    def erase(self, sectors):
+        timeout = self.dev.timeout
+        self.isp.settimeout(60)
+        try:
+            for idx, _, _ in sectors:
+                self._request(FAST_ERASE, idx)
+                self._ack(' erase sector {}'.format(idx))
+        finally:
+            self.isp.settimeout(timeout)
+
+    def crc(self, addr, length):
+        self._request(FAST_CRC, addr, length)
+        self._ack(' crc')
+        data = self.dev.read(4)
+        if len(data) != 4:
+            raise IspError('can not get crc of the loader or timeout!')
+        return struct.unpack('<I', data)[0]
+
+    def _send(self, addr, data):
+        self._request(FAST_WRITE, addr, len(data), bytes(data) + struct.pack('<I', crc32(data)))
+
+    def write(self, blocks, report=None):
+        # stream (address, data) blocks keeping up to window of them in
+        # flight, the acks come back in order so a NACKed block is sent
+        # again behind the blocks still in flight
+        blocks = iter(blocks)
+        pending = deque()
+        tries = {}
+        done = 0
+        total = 0
+        start = time.perf_counter()
+        while True:
+            while len(pending) < self.window:
+                block = next(blocks, None)
+                if block is None:
+                    break
+                self._send(*block)
+                pending.append(block)
+                total += len(block[1])
+            if not pending:
+                break
+            addr, data = pending.popleft()
+            ack = self.dev.read(1)
+            if ack == bytes([NACK]) and tries.get(addr, 0) < self.isp.retries:
+                tries[addr] = tries.get(addr, 0) + 1
+                self._send(addr, data)
+                pending.append((addr, data))
+                continue
+            if not ack:
+                raise IspError('can not get ack of the loader or timeout!')
+            check_acks(ack, ' write {}'.format(hex(addr)))
+            done += len(data)
+            if report:
+                report(done, total)
+        self.nbytes += done
+        self.elapsed += time.perf_counter() - start
+
+    def writeimage(self, fw, progress=True):
+        blocks = list(fw.blocks(self.block, skip_blank=True))
+        if progress:
+            prog = LocalBar('Writing image: ')
+            prog.maxval = sum(len(data) for _, data in blocks) or 1
+            prog.start()
+            self.write(blocks, report=lambda done, total: prog.update(done))
+            prog.finish()
+            print('write speed: {:.1f} KB/s'.format(self.rate() / 1024))
+        else:
+            self.write(blocks)
+
+    def verify(self, fw):
+        # compare the crc32 computed on target with the image
+        for addr, data in fw.segments:
+            if self.crc(addr, len(data)) != crc32(data):
+                raise Exception('verify failed: {} size {}'.format(hex(addr), len(data)))
+
+    def go(self, addr):
+        self._request(FAST_GO, addr)
+        self._ack(' go')
+
+    def rate(self):
+        return self.nbytes / self.elapsed if self.elapsed else 0.0
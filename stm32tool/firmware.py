@@ -0,0 +1,168 @@
+import os
+import struct
+
+BLANK = 0xFF
+
+ELF_MAGIC = b'\x7fELF'
+DFU_MAGIC = b'DfuSe'
+PT_LOAD = 1
+
+
+class Firmware(object):
+    # a sparse image: sorted, non overlapping (address, bytearray) segments
+    def __init__(self):
+        self.segments = []
+
+    def add(self, addr, data):
+        self.extend([(addr, data)])
+
+    def extend(self, records):
+        # merge (address, data) records into the image at once, a loader
+        # collects them first so a file is not merged record by record.
+        # Overlapping or adjacent segments are merged, the later data wins.
+        items = [(base, -1, buf) for base, buf in self.segments]
+        items += [(addr, idx, data) for idx, (addr, data) in enumerate(records) if data]
+        items.sort(key=lambda item: item[:2])
+        groups = []
+        for item in items:
+            # segments sharing a flash word are merged too, so that no
+            # word is ever programmed twice
+            if groups and groups[-1][1] >= item[0] & ~3:
+                group = groups[-1]
+                group[1] = max(group[1], item[0] + len(item[2]))
+                group[2].append(item)
+            else:
+                groups.append([item[0], item[0] + len(item[2]), [item]])
+        self.segments = []
+        for start, stop, group in groups:
+            out = bytearray([BLANK]) * (stop - start)
+            for base, _, buf in sorted(group, key=lambda item: item[1]):
+                out[base - start: base - start + len(buf)] = buf
+            self.segments.append((start, out))
+
+    def ranges(self):
+        return [(base, len(buf)) for base, buf in self.segments]
+
+    @property
+    def size(self):
+        return sum(len(buf) for _, buf in self.segments)
+
+    @property
+    def start(self):
+        return self.segments[0][0] if self.segments else None
+
+    def overlay(self, buf, addr):
+        # copy every populated byte in [addr, addr + len(buf)) into buf
+        for base, data in self.segments:
+            start = max(addr, base)
+            end = min(addr + len(buf), base + len(data))
+            if start < end:
+                buf[start - addr: end - addr] = data[start - base: end - base]
+        return buf
+
+    def blocks(self, size, skip_blank=False):
+        # (address, data) blocks of at most size bytes, word aligned
+        for base, data in self.segments:
+            pad = base % 4
+            view = memoryview(bytes([BLANK]) * pad + data) if pad else memoryview(data)
+            base -= pad
+            for off in range(0, len(view), size):
+                block = view[off: off + size]
+                if skip_blank and is_blank(block):
+                    continue
+                yield base + off, block
+
+
+def is_blank(block):
+    return bytes(block).strip(b'\xff') == b''
+
+
+def load_bin(data, addr):
+    fw = Firmware()
+    fw.add(addr, data)
+    return fw
+
+
+def load_hex(data):
+    fw = Firmware()
+    records = []
+    upper = 0
+    for num, line in enumerate(data.decode('ascii').splitlines(), 1):
+        line = line.strip()
+        if not line:
+            continue
+        if not line.startswith(':'):
+            raise Exception('hex line {}: missing start code'.format(num))
+        record = bytes.fromhex(line[1:])
+        if len(record) < 5 or len(record) != record[0] + 5:
+            raise Exception('hex line {}: bad record length'.format(num))
+        if sum(record) & 0xFF:
+            raise Exception('hex line {}: checksum error'.format(num))
+        count, offset, rtype = record[0], (record[1] << 8) | record[2], record[3]
+        payload = record[4: 4 + count]
+        if rtype == 0x00:
+            records.append((upper + offset, payload))
+        elif rtype == 0x01:
+            break
+        elif rtype == 0x02:
+            upper = int.from_bytes(payload, 'big') << 4
+        elif rtype == 0x04:
+            upper = int.from_bytes(payload, 'big') << 16
+    fw.extend(records)
+    return fw
+
+
+def load_elf(data):
+    fw = Firmware()
+    records = []
+    if data[4] not in (1, 2):
+        raise Exception('unknown elf class: {}'.format(data[4]))
+    endian = '<' if data[5] == 1 else '>'
+    if data[4] == 1:
+        phoff, = struct.unpack_from(endian + 'I', data, 0x1C)
+        phentsize, phnum = struct.unpack_from(endian + 'HH', data, 0x2A)
+        fmt = endian + 'IIIIII'
+        names = 'type offset vaddr paddr filesz memsz'
+    else:
+        phoff, = struct.unpack_from(endian + 'Q', data, 0x20)
+        phentsize, phnum = struct.unpack_from(endian + 'HH', data, 0x36)
+        fmt = endian + 'IIQQQQQ'
+        names = 'type flags offset vaddr paddr filesz memsz'
+    for i in range(phnum):
+        header = dict(zip(names.split(), struct.unpack_from(fmt, data, phoff + i * phentsize)))
+        if header['type'] != PT_LOAD or not header['filesz']:
+            continue
+        # the load address is the physical one, .data is copied from flash
+        offset = header['offset']
+        records.append((header['paddr'], data[offset: offset + header['filesz']]))
+    fw.extend(records)
+    return fw
+
+
+def load_dfu(data):
+    fw = Firmware()
+    records = []
+    _, _, _, targets = struct.unpack_from('<5sBIB', data, 0)
+    idx = 11
+    for _ in range(targets):
+        _, _, _, _, _, elements = struct.unpack_from('<6sBI255s2I', data, idx)
+        idx += 274
+        for _ in range(elements):
+            addr, esize = struct.unpack_from('<2I', data, idx)
+            idx += 8
+            records.append((addr, data[idx: idx + esize]))
+            idx += esize
+    fw.extend(records)
+    return fw
+
+
+def load(fileobj, addr=0x08000000):
+    data = fileobj.read()
+    ext = os.path.splitext(getattr(fileobj, 'name', ''))[1].lower()
+    if data.startswith(ELF_MAGIC):
+        return load_elf(data)
+    elif data.startswith(DFU_MAGIC):
+        return load_dfu(data)
+    elif ext in ('.hex', '.ihex') or (ext != '.bin' and data.startswith(b':')):
+        return load_hex(data)
+    return load_bin(data, addr)
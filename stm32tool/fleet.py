@@ -0,0 +1,157 @@
+import argparse
+import json
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from . import firmware
+from .isp import BPS, CHIPS, Isp, IspError, discover
+
+SYNC_TIMEOUT = 1
+
+
+class FleetProgress(object):
+    # the stage and written bytes of every board, printed on one line
+    def __init__(self, ports, stream=sys.stdout):
+        self.stream = stream
+        self._lock = threading.Lock()
+        self._state = dict((port, ['wait', 0, 0]) for port in ports)
+        self._width = 0
+
+    def stage(self, port, stage):
+        with self._lock:
+            self._state[port][0] = stage
+
+    def report(self, port):
+        def callback(done, total):
+            with self._lock:
+                self._state[port][1:] = [done, total]
+        return callback
+
+    def line(self):
+        items = []
+        with self._lock:
+            for port, (stage, done, total) in self._state.items():
+                if stage == 'write' and total:
+                    stage = '{}%'.format(done * 100 // total)
+                items.append('{}:{}'.format(port.split('/')[-1], stage))
+        return ' '.join(items)
+
+    def show(self):
+        line = self.line()
+        self.stream.write('\r' + line.ljust(self._width))
+        self._width = len(line)
+        self.stream.flush()
+
+
+def flash_board(port, image, bps=460800, mass=False, go=True, progress=None, parity='E'):
+    result = {'port': port, 'ok': False, 'bytes': 0}
+    start = time.time()
+    stage = progress.stage if progress else lambda port, stage: None
+    board = None
+    try:
+        stage(port, 'sync')
+        board = Isp(port, bps, timeout=SYNC_TIMEOUT, parity=parity)
+        board.verbose = False
+        if not board.sync():
+            raise IspError('no answer of the bootloader')
+        board.getCmd()
+        board.getId()
+        board.settimeout(5)
+        result['id'] = hex(board.id)
+        result['chip'] = CHIPS[board.id].name if board.id in CHIPS else 'Unknown'
+        result['sync'] = round(time.time() - start, 3)
+
+        stage(port, 'erase')
+        tick = time.time()
+        if mass:
+            board.erasemem(True)
+        else:
+            board.eraseimage(image)
+        result['erase'] = round(time.time() - tick, 3)
+
+        stage(port, 'write')
+        tick = time.time()
+        board.writeimage(image, progress=False, report=progress.report(port) if progress else None)
+        result['write'] = round(time.time() - tick, 3)
+        result['bytes'] = board.link.nbytes
+        result['retries'] = board.retried
+
+        if go:
+            board.go(image.start)
+        result['ok'] = True
+        stage(port, 'done')
+    except Exception as e:
+        result['error'] = str(e) or e.__class__.__name__
+        stage(port, 'fail')
+    finally:
+        if board is not None and board.dev:
+            board.dev.close()
+            board.dev = None
+    result['total'] = round(time.time() - start, 3)
+    return result
+
+
+def flash_fleet(ports, image, workers=16, progress=None, **kwargs):
+    # one isp session per port, the fleet takes as long as the slowest board
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(ports)))) as pool:
+        futures = [pool.submit(flash_board, port, image, progress=progress, **kwargs)
+                   for port in ports]
+        while progress and not all(f.done() for f in futures):
+            progress.show()
+            time.sleep(0.5)
+        results = [f.result() for f in futures]
+    if progress:
+        progress.show()
+        progress.stream.write('\n')
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input', type=argparse.FileType(mode='rb'), help='the image for downloading: binary, intel hex, elf or dfu')
+    parser.add_argument('ports', nargs='*', help='serial device names, all ports answering the isp sync when empty')
+    parser.add_argument('-b', '--bps', default=460800, choices=BPS, type=int, help='baudrate of every board')
+    parser.add_argument('-a', '--addr', type=int, default=0x08000000, help='address of a binary image')
+    parser.add_argument('-m', '--mass', action='store_true', default=False, help='mass erase instead of erasing the image sectors')
+    parser.add_argument('-n', '--no-exe', action='store_true', default=False, help='do not start running the boards')
+    parser.add_argument('-w', '--workers', type=int, default=16, help='boards flashed at the same time')
+    parser.add_argument('-s', '--summary', type=argparse.FileType(mode='w'), help='write a json summary of the boards')
+    args = parser.parse_args()
+
+    image = firmware.load(args.input, args.addr)
+    if not image.segments:
+        print('The image is empty')
+        exit()
+
+    ports = args.ports or [boot.port for boot in discover(bps=args.bps)]
+    if not ports:
+        print('Please connect your boards using serial')
+        exit()
+
+    start = time.time()
+    progress = FleetProgress(ports)
+    results = flash_fleet(ports, image, args.workers, progress, bps=args.bps,
+                          mass=args.mass, go=not args.no_exe)
+    summary = {
+        'image': {'start': hex(image.start), 'size': image.size},
+        'total': round(time.time() - start, 3),
+        'ok': sum(1 for r in results if r['ok']),
+        'failed': sum(1 for r in results if not r['ok']),
+        'boards': results,
+    }
+    for r in results:
+        if r['ok']:
+            print('{}: {} ok, {:.1f}s'.format(r['port'], r['chip'], r['total']))
+        else:
+            print('{}: failed, {}'.format(r['port'], r['error']))
+    print('{} ok, {} failed in {:.1f}s'.format(summary['ok'], summary['failed'], summary['total']))
+    if args.summary:
+        json.dump(summary, args.summary, indent=1)
+    if summary['failed']:
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
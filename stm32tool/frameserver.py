@@ -0,0 +1,299 @@
+import argparse
+import base64
+import hashlib
+import select
+import socket
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from .entry.data import hello_world
+from .openmv import OpenMV
+from .recorder import Replay
+
+WS_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC11B65'
+WS_BINARY = 0x2
+WS_CLOSE = 0x8
+WS_PING = 0x9
+WS_PONG = 0xA
+BOUNDARY = b'frame'
+CLIENT_TIMEOUT = 10
+
+INDEX = b'''<!DOCTYPE html>
+<html><head><title>OpenMV</title></head>
+<body><img src="/stream.mjpg"></body></html>
+'''
+
+
+class FrameHub(object):
+    # the newest frame of the camera and its sequence number. The capture
+    # only replaces it, so it never waits for a client; a client which is
+    # slower than the camera gets the newest frame when it is ready again
+    # and the frames in between are dropped for it.
+    def __init__(self, quality=80):
+        self.quality = quality
+        self.seq = 0
+        self.frame = None
+        self.clients = 0
+        self.sent = 0
+        self.dropped = 0
+        self.closed = False
+        self._cond = threading.Condition()
+        # (seq, jpeg) of the last encoded frame, encoding is serialized so
+        # the clients waiting for a frame share one encode
+        self._jpeg = (0, None)
+        self._encode = threading.Lock()
+
+    def publish(self, frame):
+        with self._cond:
+            self.frame = frame
+            self.seq += 1
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def wait(self, seq, timeout=1.0):
+        # (seq, jpeg) of the first frame newer than seq, None when closed.
+        # JPEG is encoded once for all clients, camera JPEG is passed through.
+        deadline = time.time() + timeout
+        with self._cond:
+            while self.seq <= seq and not self.closed:
+                remain = deadline - time.time()
+                if remain <= 0:
+                    return seq, None
+                self._cond.wait(remain)
+            if self.closed:
+                return None
+            new, frame = self.seq, self.frame
+            if seq:
+                self.dropped += new - seq - 1
+            self.sent += 1
+        return new, self.jpeg(new, frame)
+
+    def jpeg(self, seq, frame):
+        with self._encode:
+            if self._jpeg[0] == seq:
+                return self._jpeg[1]
+            jpeg = frame.jpeg(self.quality)
+            # a client late for a newer frame does not replace it
+            if seq > self._jpeg[0]:
+                self._jpeg = (seq, jpeg)
+            return jpeg
+
+    def __enter__(self):
+        with self._cond:
+            self.clients += 1
+        return self
+
+    def __exit__(self, *args):
+        with self._cond:
+            self.clients -= 1
+
+
+def ws_accept(key):
+    return base64.b64encode(hashlib.sha1(key.encode() + WS_GUID).digest()).decode()
+
+
+def ws_frame(opcode, payload):
+    length = len(payload)
+    if length < 126:
+        head = struct.pack('!BB', 0x80 | opcode, length)
+    elif length < 0x10000:
+        head = struct.pack('!BBH', 0x80 | opcode, 126, length)
+    else:
+        head = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+    return head + payload
+
+
+class FrameHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def hub(self):
+        return self.server.hub
+
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        if path == '/':
+            self._reply(200, 'text/html', INDEX)
+        elif path == '/frame.jpg':
+            _, jpeg = self.hub.wait(0) or (0, None)
+            if jpeg is None:
+                self._reply(503, 'text/plain', b'no frame')
+            else:
+                self._reply(200, 'image/jpeg', jpeg)
+        elif path == '/stream.mjpg':
+            self._mjpeg()
+        elif path == '/ws' and self.headers.get('Upgrade', '').lower() == 'websocket':
+            self._websocket()
+        else:
+            self._reply(404, 'text/plain', b'not found')
+
+    def _reply(self, code, ctype, body):
+        self.send_response(code)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _frames(self):
+        # every jpeg this client can take, None when it is idle
+        seq = self.hub.seq - 1 if self.hub.seq else 0
+        while True:
+            got = self.hub.wait(seq)
+            if got is None:
+                return
+            seq, jpeg = got
+            yield jpeg
+
+    def _mjpeg(self):
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary={}'.format(BOUNDARY.decode()))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.connection.settimeout(CLIENT_TIMEOUT)
+        with self.hub:
+            try:
+                for jpeg in self._frames():
+                    if jpeg is None:
+                        continue
+                    self.wfile.write(b'--' + BOUNDARY + b'\r\nContent-Type: image/jpeg\r\n'
+                                     b'Content-Length: ' + str(len(jpeg)).encode() + b'\r\n\r\n')
+                    self.wfile.write(jpeg)
+                    self.wfile.write(b'\r\n')
+            except (OSError, socket.timeout):
+                pass
+
+    def _websocket(self):
+        self.close_connection = True
+        self.send_response(101)
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', ws_accept(self.headers.get('Sec-WebSocket-Key', '')))
+        self.end_headers()
+        self.connection.settimeout(CLIENT_TIMEOUT)
+        with self.hub:
+            try:
+                for jpeg in self._frames():
+                    if not self._ws_receive():
+                        break
+                    if jpeg is not None:
+                        self.wfile.write(ws_frame(WS_BINARY, jpeg))
+            except (OSError, socket.timeout):
+                pass
+
+    def _ws_receive(self):
+        # handle what the client sent, False when it closes
+        while select.select([self.connection], [], [], 0)[0]:
+            head = self.rfile.read(2)
+            if len(head) < 2:
+                return False
+            opcode, length = head[0] & 0x0F, head[1] & 0x7F
+            if length == 126:
+                length = struct.unpack('!H', self.rfile.read(2))[0]
+            elif length == 127:
+                length = struct.unpack('!Q', self.rfile.read(8))[0]
+            mask = self.rfile.read(4) if head[1] & 0x80 else b'\x00' * 4
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(self.rfile.read(length)))
+            if opcode == WS_CLOSE:
+                self.wfile.write(ws_frame(WS_CLOSE, payload[:2]))
+                return False
+            if opcode == WS_PING:
+                self.wfile.write(ws_frame(WS_PONG, payload))
+        return True
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FrameServer(object):
+    # reads every frame of one camera once and serves it to many local
+    # clients: http://host:port/stream.mjpg (multipart MJPEG), ws://host:port/ws
+    # (a binary message of JPEG per frame) and /frame.jpg (the newest one)
+    def __init__(self, cam, host='127.0.0.1', port=8080, quality=80):
+        self.cam = cam
+        self.hub = FrameHub(quality)
+        self.server = ThreadingServer((host, port), FrameHandler)
+        self.server.hub = self.hub
+        self.frames = 0
+        self._stop = threading.Event()
+        self._threads = []
+
+    @property
+    def address(self):
+        return self.server.server_address
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        self._stop.clear()
+        for target in (self._capture, self.server.serve_forever):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _capture(self):
+        # lazy frames: nothing is decoded unless a client needs a re-encode
+        for frame in self.cam.fb_stream(lazy=True, stop=self._stop):
+            self.frames += 1
+            self.hub.publish(frame)
+
+    def stop(self):
+        self._stop.set()
+        self.hub.close()
+        self.server.shutdown()
+        self.server.server_close()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-H', '--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('-p', '--port', type=int, default=8080, help='port to listen on')
+    parser.add_argument('-f', '--file', help='script file')
+    parser.add_argument('-q', '--quality', type=int, default=80, help='JPEG quality of raw frames')
+    parser.add_argument('-r', '--replay', help='serve a recording instead of the camera')
+    args = parser.parse_args()
+
+    cam = Replay(args.replay, realtime=True, loop=True) if args.replay else OpenMV()
+    if not cam.connect():
+        exit()
+    cam.stop_script()
+    cam.fb_enable(True)
+    cam.exec_script(open(args.file, 'r').read() if args.file else hello_world)
+
+    server = FrameServer(cam, args.host, args.port, args.quality)
+    server.start()
+    print('serving on http://{}:{}/stream.mjpg and ws://{}:{}/ws'.format(args.host, args.port, args.host, args.port))
+    try:
+        while True:
+            time.sleep(5)
+            hub = server.hub
+            print('{} frames, {} clients, {} sent, {} dropped'.format(server.frames, hub.clients, hub.sent, hub.dropped))
+    except KeyboardInterrupt:
+        pass
+    server.stop()
+    cam.stop_script()
+    cam.disconnect()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+POLL_INTERVAL = 0.002
+
+
+class FrameGrabber(object):
+    # pulls frames of an OpenMV camera on a thread into a small ring of
+    # preallocated arrays, so serial transfer and consumer overlap.
+    #   latest: frames() always gives the newest frame, older ones are dropped
+    #   drop:   frames() gives every queued frame, the oldest is dropped when full
+    #   block:  frames() gives every frame, the grabber waits for the consumer
+    # The array of a frame stays valid until the next frame is taken.
+    # tap(frame) gets every undecoded Frame before it is decoded, e.g.
+    # Recorder.add.
+    def __init__(self, cam, slots=3, policy='latest', tap=None):
+        if policy not in ('latest', 'drop', 'block'):
+            raise ValueError('unknown drop policy: {}'.format(policy))
+        self.cam = cam
+        self.slots = max(3, slots)
+        self.policy = policy
+        self.tap = tap
+        self.seq = 0
+        self.dropped = 0
+        self._ring = {}
+        self._frames = [None] * self.slots
+        self._queue = deque()
+        self._latest = None
+        self._leased = None
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+        self._times = deque(maxlen=30)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        with self._cond:
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and not self._stop.is_set()
+
+    @property
+    def fps(self):
+        if len(self._times) < 2:
+            return 0.0
+        return (len(self._times) - 1) / (self._times[-1] - self._times[0])
+
+    def _buffer(self, slot):
+        def alloc(w, h):
+            ring = self._ring.get((w, h))
+            if ring is None:
+                ring = self._ring[(w, h)] = [np.empty((h, w, 3), dtype=np.uint8)
+                                             for _ in range(self.slots)]
+            return ring[slot]
+        return alloc
+
+    def _free_slot(self):
+        busy = set(self._queue)
+        busy.update((self._latest, self._leased))
+        for slot in range(self.slots):
+            if slot not in busy:
+                return slot
+        return None
+
+    def _take_slot(self):
+        with self._cond:
+            slot = self._free_slot()
+            while slot is None and not self._stop.is_set():
+                if self.policy == 'block':
+                    self._cond.wait(0.1)
+                else:
+                    self._queue.popleft()
+                    self.dropped += 1
+                slot = self._free_slot()
+            return slot
+
+    def _grab(self, slot):
+        tap = self.tap
+        if tap is None:
+            return self.cam.fb_dump(self._buffer(slot))
+        frame = self.cam.fb_dump(lazy=True)
+        if frame is None:
+            return None
+        tap(frame)
+        out = frame.rgb(self._buffer(slot)(frame.width, frame.height))
+        return (frame.width, frame.height, out)
+
+    def _run(self):
+        while not self._stop.is_set():
+            slot = self._take_slot()
+            if slot is None:
+                break
+            try:
+                frame = self._grab(slot)
+            except Exception:
+                if self._stop.is_set():
+                    break
+                raise
+            if frame is None:
+                time.sleep(POLL_INTERVAL)
+                continue
+            with self._cond:
+                self._frames[slot] = frame
+                self.seq += 1
+                self._times.append(time.time())
+                if self.policy == 'latest':
+                    if self._queue:
+                        self.dropped += 1
+                    self._queue.clear()
+                self._queue.append(slot)
+                self._latest = slot
+                self._cond.notify_all()
+
+    def latest(self):
+        # the newest frame (w, h, image) without waiting, or None
+        with self._cond:
+            if self._latest is None:
+                return None
+            self._leased = self._latest
+            if self._latest in self._queue:
+                self._queue.remove(self._latest)
+            return self._frames[self._latest]
+
+    def get(self, timeout=None):
+        # the next frame by the drop policy, None on timeout or stop
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while not self._queue:
+                if self._stop.is_set():
+                    return None
+                remain = None if deadline is None else deadline - time.time()
+                if remain is not None and remain <= 0:
+                    return None
+                self._cond.wait(remain if remain is not None else 0.1)
+            slot = self._queue.popleft()
+            self._leased = slot
+            self._cond.notify_all()
+            return self._frames[slot]
+
+    def frames(self, timeout=None):
+        while True:
+            frame = self.get(timeout)
+            if frame is None:
+                return
+            yield frame
+
+    def __iter__(self):
+        return self.frames()
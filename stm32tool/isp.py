@@ -1,4 +1,11 @@
 import argparse
+import hashlib
+import json
+import os
+import struct
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from functools import reduce
 from operator import xor
 
@@ -6,22 +13,31 @@ import serial
 from progressbar import ProgressBar, widgets
 from serial.tools import list_ports
 
+from . import firmware
+
+# flash layout of every chip: flash base address, flash size and the
+# sectors as (count, size) runs, the sector index is used by the erase
+Chip = namedtuple('Chip', 'name base flash sectors')
+
+F2_F4_SECTORS = ((4, 0x4000), (1, 0x10000), (7, 0x20000))
+F7_SECTORS = ((4, 0x8000), (1, 0x20000), (7, 0x40000))
+
 CHIPS = {
-    0x410: 'STM32F10x Medium-density',
-    0x411: 'STM32F2xxx',
-    0x412: 'STM32F10x Low-density',
-    0x413: 'STM32F40xxx/41xxx',
-    0x414: 'STM32F10x High-density',
-    0x416: 'STM32L1xxx6(8/B) Medium-density ultralow power line',
-    0x419: 'STM3242xxx/43xxx',
-    0x420: 'STM32F10x Medium-density value line',
-    0x428: 'STM32F10x High-density value line',
-    0x430: 'STM3210xx XL-density',
-    0x444: 'STM32F03xx4/6',
-    0x449: 'STM32F74xxx/75xxx',
-    0x451: 'STM32F76xxx/77xxx',
-    0x801: 'Wiznet W7500',
-    0x11103: 'BlueNRG',
+    0x410: Chip('STM32F10x Medium-density', 0x08000000, 0x20000, ((128, 0x400),)),
+    0x411: Chip('STM32F2xxx', 0x08000000, 0x100000, F2_F4_SECTORS),
+    0x412: Chip('STM32F10x Low-density', 0x08000000, 0x8000, ((32, 0x400),)),
+    0x413: Chip('STM32F40xxx/41xxx', 0x08000000, 0x100000, F2_F4_SECTORS),
+    0x414: Chip('STM32F10x High-density', 0x08000000, 0x80000, ((256, 0x800),)),
+    0x416: Chip('STM32L1xxx6(8/B) Medium-density ultralow power line', 0x08000000, 0x20000, ((512, 0x100),)),
+    0x419: Chip('STM3242xxx/43xxx', 0x08000000, 0x200000, F2_F4_SECTORS*2),
+    0x420: Chip('STM32F10x Medium-density value line', 0x08000000, 0x20000, ((128, 0x400),)),
+    0x428: Chip('STM32F10x High-density value line', 0x08000000, 0x80000, ((256, 0x800),)),
+    0x430: Chip('STM3210xx XL-density', 0x08000000, 0x100000, ((512, 0x800),)),
+    0x444: Chip('STM32F03xx4/6', 0x08000000, 0x8000, ((32, 0x400),)),
+    0x449: Chip('STM32F74xxx/75xxx', 0x08000000, 0x100000, F7_SECTORS[:2] + ((3, 0x40000),)),
+    0x451: Chip('STM32F76xxx/77xxx', 0x08000000, 0x200000, F7_SECTORS),
+    0x801: Chip('Wiznet W7500', 0x00000000, 0x20000, ((512, 0x100),)),
+    0x11103: Chip('BlueNRG', 0x10040000, 0x28000, ((80, 0x800),)),
 }
 
 INIT        = 0x7F
@@ -41,6 +57,8 @@ READPC      = 0x82
 READUPC     = 0x92
 
 MAX_BUF_SIZE = 0x100
+MAX_ERASE_PAGES = 0xFF
+ERASE_TIMEOUT = 60
 
 CMDS = {
     0x00: 'Get Command',
@@ -59,20 +77,274 @@ CMDS = {
 
 BPS = (460800, 25600, 230400, 12800, 115200, 76800, 57600, 38400, 19200, 14400, 9600)
 
+BAUD_CACHE = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+                          'stm32tool', 'baud.json')
+PROBE_SIZE = 0x400
+PROBE_TIMEOUT = 0.5
+DISCOVER_TIMEOUT = 0.2
+
 def LocalBar(buf):
     DEFAULT_WIDGETS = [buf.ljust(12), widgets.Bar(marker='#', left='[', right=']'), '  ', widgets.Percentage(), '  ', widgets.ETA()]
     prog = ProgressBar(term_width=80, widgets=DEFAULT_WIDGETS)
     return prog
 
+class IspError(Exception):
+    # a NACK, timeout or garbled reply on the link, the command can be retried
+    pass
+
+
+def check_acks(acks, info=''):
+    for ack in acks:
+        if ack == NACK:
+            raise IspError('NACK' + info)
+        elif ack != ACK:
+            raise IspError('Unknown error: {}'.format(hex(ack)))
+
+
+class Transport(object):
+    # every command phase is packed into one preallocated frame buffer and
+    # sent with a single write, in pipeline mode all phases of a command go
+    # out in one write and the acks are collected with a single read
+    def __init__(self, dev, pipeline=False):
+        self.dev = dev
+        self.pipeline = pipeline
+        self._buf = bytearray(2 + 2*(MAX_ERASE_PAGES + 1) + 1)
+        self._view = memoryview(self._buf)
+        self._len = 0
+        self._acks = 0
+        self.nbytes = 0
+        self.elapsed = 0.0
+
+    def putbyte(self, val):
+        self._buf[self._len] = val
+        self._buf[self._len + 1] = val ^ 0xFF
+        self._len += 2
+        self._acks += 1
+
+    def putaddr(self, addr):
+        idx = self._len
+        struct.pack_into('>I', self._buf, idx, addr)
+        self._buf[idx + 4] = reduce(xor, self._view[idx: idx + 4])
+        self._len += 5
+        self._acks += 1
+
+    def putdata(self, data):
+        idx = self._len
+        length = len(data)
+        self._buf[idx] = length - 1
+        self._buf[idx + 1: idx + 1 + length] = data
+        self._buf[idx + 1 + length] = reduce(xor, data, length - 1)
+        self._len += length + 2
+        self._acks += 1
+
+    def putraw(self, data):
+        idx = self._len
+        length = len(data)
+        self._buf[idx: idx + length] = data
+        self._buf[idx + length] = reduce(xor, data, 0)
+        self._len += length + 1
+        self._acks += 1
+
+    def sync(self, info=''):
+        if not self.pipeline:
+            self.flush(info=info)
+
+    def flush(self, reply=0, info='', into=None):
+        # the reply is returned as bytes, or read straight into the
+        # writable buffer 'into' when it is given
+        start = time.perf_counter()
+        if self._len:
+            self.dev.write(self._view[:self._len])
+            self.nbytes += self._len
+        acks, self._len, self._acks = self._acks, 0, 0
+        if into is not None:
+            data = self.dev.read(acks)
+        else:
+            data = self.dev.read(acks + reply)
+        if len(data) < acks:
+            self.elapsed += time.perf_counter() - start
+            raise IspError('can not get ack or timeout!')
+        check_acks(data[:acks], info)
+        if into is not None:
+            count = self.dev.readinto(into)
+            data = None
+        else:
+            data = data[acks:]
+            count = len(data)
+        self.elapsed += time.perf_counter() - start
+        self.nbytes += count
+        if count != (len(into) if into is not None else reply):
+            raise IspError('can not read memory or timeout!')
+        return data
+
+    def discard(self):
+        self._len, self._acks = 0, 0
+
+    def reset_stats(self):
+        self.nbytes = 0
+        self.elapsed = 0.0
+
+    def rate(self):
+        return self.nbytes / self.elapsed if self.elapsed else 0.0
+
+
+class Journal(object):
+    # the blocks of an image already written, so an interrupted session
+    # can resume. The first line identifies the image, every next line is
+    # the address of one written block.
+    def __init__(self, path, fw):
+        self.path = path
+        self.digest = image_digest(fw)
+        self.done = set()
+        self._file = None
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                lines = f.read().split()
+            if lines and lines[0] == self.digest:
+                self.done = set(int(line, 16) for line in lines[1:])
+
+    def __contains__(self, addr):
+        return addr in self.done
+
+    def __len__(self):
+        return len(self.done)
+
+    def add(self, addr):
+        if not self._file:
+            self._file = open(self.path, 'a' if self.done else 'w')
+            if not self.done:
+                self._file.write(self.digest + '\n')
+        self.done.add(addr)
+        self._file.write('{:08x}\n'.format(addr))
+        self._file.flush()
+
+    def finish(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def image_digest(fw):
+    digest = hashlib.sha1()
+    for addr, data in fw.segments:
+        digest.update(struct.pack('<II', addr, len(data)))
+        digest.update(data)
+    return digest.hexdigest()
+
+
+def load_baud(port):
+    try:
+        with open(BAUD_CACHE, 'r') as f:
+            return json.load(f).get(port)
+    except (OSError, ValueError):
+        return None
+
+
+def save_baud(port, bps):
+    try:
+        with open(BAUD_CACHE, 'r') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    cache[port] = bps
+    os.makedirs(os.path.dirname(BAUD_CACHE), exist_ok=True)
+    with open(BAUD_CACHE, 'w') as f:
+        json.dump(cache, f, indent=1)
+
+
+def autobaud(port, reset=None, timeout=5, **kwargs):
+    # try the cached rate of the port first, then sync at every rate from
+    # the fastest down and keep the first one with a clean read probe.
+    # The bootloader keeps the rate of its first sync byte until reset, so
+    # without a reset line only the fastest rate can be tried.
+    cached = load_baud(port)
+    rates = sorted(BPS, reverse=True)
+    if cached in rates:
+        board = Isp(port, cached, timeout=PROBE_TIMEOUT, **kwargs)
+        try:
+            if board.sync():
+                board.getCmd()
+                board.getId()
+                board.settimeout(timeout)
+                return board
+        except IspError:
+            pass
+        board.dev.close()
+    for bps in rates:
+        board = Isp(port, bps, timeout=PROBE_TIMEOUT, **kwargs)
+        board.reset_board(reset)
+        try:
+            rate = 0.0
+            if board.sync():
+                board.getCmd()
+                board.getId()
+                rate = board.probe()
+        except IspError:
+            rate = 0.0
+        if rate:
+            print('baudrate: {}, read speed: {:.1f} KB/s'.format(bps, rate / 1024))
+            save_baud(port, bps)
+            board.settimeout(timeout)
+            return board
+        board.dev.close()
+        if not reset:
+            print('baudrate {} does not work, slower ones need a reset line (-R)'.format(bps))
+            break
+    return None
+
+
+Bootloader = namedtuple('Bootloader', 'port id version')
+
+
+def probe_port(port, bps=115200, timeout=DISCOVER_TIMEOUT, parity='E'):
+    # the bootloader answering on the port, or None
+    try:
+        board = Isp(port, bps, timeout=timeout, retries=0, parity=parity)
+    except Exception:
+        return None
+    try:
+        if not board.sync():
+            return None
+        board.getCmd()
+        board.getId()
+        return Bootloader(port, board.id, board.version)
+    except Exception:
+        return None
+    finally:
+        board.dev.close()
+        board.dev = None
+
+
+def discover(ports=None, bps=115200, timeout=DISCOVER_TIMEOUT, workers=32, parity='E'):
+    # probe all the ports at the same time, so discovery takes about one
+    # timeout whatever the number of ports
+    if ports is None:
+        ports = [port.device for port in list_ports.comports()]
+    if not ports:
+        return []
+    with ThreadPoolExecutor(max_workers=min(workers, len(ports))) as pool:
+        found = pool.map(lambda port: probe_port(port, bps, timeout, parity), ports)
+    return [boot for boot in found if boot]
+
+
 class Isp(object):
-    def __init__(self, portname, bps=115200, timeout=5):
+    def __init__(self, portname, bps=115200, timeout=5, pipeline=False, retries=3, parity='E'):
         self.version = None
         self.cmd = None
         self.id = None
+        self.retries = retries
+        self.retried = 0
+        self.verbose = True
         try:
-            self.dev = serial.Serial( portname, baudrate=bps, parity='E', timeout=timeout)
+            self.dev = serial.Serial( portname, baudrate=bps, parity=parity, timeout=timeout)
         except Exception as e:
             raise e
+        self.link = Transport(self.dev, pipeline)
+
+    def settimeout(self, timeout):
+        self.dev.timeout = timeout
 
     def _readint(self):
         val = self.dev.read()
@@ -88,7 +360,7 @@ class Isp(object):
         try:
             ack = self._readint()
         except Exception:
-            raise Exception('can not get ack or timeout!')
+            raise IspError('can not get ack or timeout!')
         else:
             if ack == ACK:
                 return True
@@ -97,9 +369,9 @@ class Isp(object):
                     print('Please reset board')
                     return False
                 if ack == NACK:
-                    raise Exception('NACK' + info)
+                    raise IspError('NACK' + info)
                 else:
-                    raise Exception('Unknown error: {}'.format(hex(ack)))
+                    raise IspError('Unknown error: {}'.format(hex(ack)))
 
     def write(self, data):
         if isinstance(data, int):
@@ -108,37 +380,78 @@ class Isp(object):
 
     def writecmd_ack(self, cmd):
         self._check_cmd(cmd)
-        self.write([cmd, cmd ^ 0xFF])
-        self._wait_ack()
+        self.link.putbyte(cmd)
+        self.link.flush()
 
     def writeadd_ack(self, addr):
-        data = addr.to_bytes(4, byteorder='big')
-        self.write(data)
-        self.write(reduce(xor, data))
-        self._wait_ack()
+        self.link.putaddr(addr)
+        self.link.flush()
 
     def writedat_ack(self, data):
-        length = len(data) - 1
-        self.write(length)
-        self.write(data)
-        self.write(reduce(xor, data, length))
-        self._wait_ack()
+        self.link.putdata(data)
+        self.link.flush()
 
     def _check_cmd(self, cmd):
         if self.cmd and cmd not in self.cmd:
             raise Exception('can not support cmd: {}'.format(hex(cmd)))
 
-    def init(self):
-        self.write(INIT)
-        if self._wait_ack(self, 1):
+    def sync(self, synced=False):
+        # a bootloader synced before takes the sync byte for the first half
+        # of a command and waits for the second one, a second sync byte then
+        # makes it answer with a NACK. With synced, as after discover, the
+        # first answer is not waited for longer than discovery does.
+        self.dev.reset_input_buffer()
+        timeout = self.dev.timeout
+        if synced:
+            self.settimeout(min(timeout, DISCOVER_TIMEOUT))
+        try:
+            self.write(INIT)
+            ack = self._readint()
+        finally:
+            if synced:
+                self.settimeout(timeout)
+        if not ack:
+            self.write(INIT)
+            ack = self._readint()
+        return ack in (ACK, NACK)
+
+    def reset_board(self, line=None):
+        # pulse the reset line, the modem lines are active low
+        if line not in ('dtr', 'rts'):
+            input('Please reset board into bootloader and press enter')
+            return
+        setattr(self.dev, line, True)
+        time.sleep(0.1)
+        setattr(self.dev, line, False)
+        time.sleep(0.1)
+
+    def probe(self):
+        # bytes/s of reading the flash twice, 0 when the link is not clean
+        base = CHIPS[self.id].base if self.id in CHIPS else 0x08000000
+        retries, self.retries = self.retries, 0
+        try:
+            first = self.readbuf(base, PROBE_SIZE, progress=False)
+            second = self.readbuf(base, PROBE_SIZE, progress=False)
+        except IspError:
+            return 0.0
+        finally:
+            self.retries = retries
+        return self.link.rate() if first == second else 0.0
+
+    def init(self, synced=False):
+        if self.sync(synced):
             self.getCmd()
             self.getId()
             return
+        print('Please reset board')
         print('init device timeout')
         exit()
 
     def getCmd(self):
         self.writecmd_ack(GETCMD)
+        self._readcmds()
+
+    def _readcmds(self):
         cmd_num = self._readint()
         self.version = hex(self._readint())
         self.cmd = self._readlist(cmd_num)
@@ -147,6 +460,33 @@ class Isp(object):
             raise Exception('cmd number is error: act:{}, ep:{}'.format(
                 len(self.cmd), cmd_num))
 
+    def resync(self):
+        # bring the bootloader back to waiting for a command: fill up any
+        # frame it still waits for, drop the replies and get the commands
+        self.link.discard()
+        for _ in range(self.retries + 1):
+            self.dev.reset_output_buffer()
+            self.dev.write(bytes([0xFF]) * (MAX_BUF_SIZE + 2))
+            time.sleep(0.1)
+            self.dev.reset_input_buffer()
+            self.dev.write([GETCMD, GETCMD ^ 0xFF])
+            if self._readint() == ACK:
+                self._readcmds()
+                return
+        raise IspError('can not resync with the bootloader')
+
+    def retry(self, func, *args):
+        for attempt in range(self.retries + 1):
+            try:
+                return func(*args)
+            except IspError as e:
+                if attempt == self.retries:
+                    raise
+                self.retried += 1
+                if self.verbose:
+                    print('\n{}, retry {}/{}'.format(e, attempt + 1, self.retries))
+                self.resync()
+
     def getVer(self):
         self.writecmd_ack(GETVER)
         self.version = hex(self._readint())
@@ -163,25 +503,56 @@ class Isp(object):
     def readmem(self, addr=0x08000000, length=0x16):
         if length > MAX_BUF_SIZE:
             raise Exception('max length is {}'.format(MAX_BUF_SIZE))
-        self.writecmd_ack(READM)
-        self.writeadd_ack(addr)
-        self.dev.write([length-1, (length-1) ^ 0xFF])
-        self._wait_ack()
-        return self.dev.read(length)
+        self._check_cmd(READM)
+        self.link.putbyte(READM)
+        self.link.sync()
+        self.link.putaddr(addr)
+        self.link.sync()
+        self.link.putbyte(length - 1)
+        return self.link.flush(length)
+
+    def readmeminto(self, buf, addr=0x08000000):
+        length = len(buf)
+        if length > MAX_BUF_SIZE:
+            raise Exception('max length is {}'.format(MAX_BUF_SIZE))
+        self._check_cmd(READM)
+        self.link.putbyte(READM)
+        self.link.sync()
+        self.link.putaddr(addr)
+        self.link.sync()
+        self.link.putbyte(length - 1)
+        self.link.flush(into=buf)
 
     def writemem(self, data, addr=0x08000000):
         length = len(data)
         _, remain = divmod(length, 4)
         if remain:
-            data += bytes([0xFF]*(4 - remain))
+            data = bytes(data) + bytes([0xFF]*(4 - remain))
             length += 4 - remain
         if length > MAX_BUF_SIZE:
             raise Exception('max length is {}'.format(MAX_BUF_SIZE))
-        self.writecmd_ack(WRITEM)
-        self.writeadd_ack(addr)
-        self.writedat_ack(data)
+        self._check_cmd(WRITEM)
+        self.link.putbyte(WRITEM)
+        self.link.sync()
+        self.link.putaddr(addr)
+        self.link.sync()
+        self.link.putdata(data)
+        self.link.flush()
 
     def erasemem(self, all=False, pages=None):
+        timeout = self.dev.timeout
+        self.settimeout(max(timeout, ERASE_TIMEOUT))
+        try:
+            if self.cmd and EERASEM in self.cmd:
+                self._eerasemem(all, pages)
+            else:
+                self._erasemem(all, pages)
+        finally:
+            self.settimeout(timeout)
+
+    def _erasemem(self, all, pages):
+        if not all and max(pages) > 0xFF:
+            raise Exception('page {} can not be erased by legacy erase'.format(max(pages)))
         self.writecmd_ack(ERASEM)
         if all:
             self.dev.write([0xFF, 0x00])
@@ -189,6 +560,14 @@ class Isp(object):
         else:
             self.writedat_ack(pages)
 
+    def _eerasemem(self, all, pages):
+        self.writecmd_ack(EERASEM)
+        if all:
+            self.link.putraw(b'\xFF\xFF')
+        else:
+            self.link.putraw(struct.pack('>{}H'.format(len(pages) + 1), len(pages) - 1, *pages))
+        self.link.flush()
+
     def writeProtect(self, sectors=None):
         self.writecmd_ack(WRITEPC)
         self.writedat_ack(sectors)
@@ -208,10 +587,11 @@ class Isp(object):
     def go(self, addr=0x08000000):
         self.writecmd_ack(GOCMD)
         self.writeadd_ack(addr)
-        print('go: {}'.format(hex(addr)))
+        if self.verbose:
+            print('go: {}'.format(hex(addr)))
 
     def info(self):
-        board_info = CHIPS[self.id] if self.id in CHIPS.keys() else 'Unknown'
+        board_info = CHIPS[self.id].name if self.id in CHIPS.keys() else 'Unknown'
         print('id:{} board: {}'.format(hex(self.id), board_info))
         print('bootloader version:{}'.format(self.version))
 
@@ -223,60 +603,200 @@ class Isp(object):
             else:
                 raise Exception('can not support cmd {}'.format(hex(key)))
 
-    def writebin(self, buf, addr=0x08000000):
+    def writebin(self, buf, addr=0x08000000, progress=True, skip_blank=False):
         size = MAX_BUF_SIZE
-        sectors, remain = divmod(len(buf), size)
-        prog = LocalBar('Writing image: ')
-        for i in prog(range(sectors)):
-            self.writemem(buf[i*size: (i+1)*size], addr+size*i)
-        if remain:
-            self.writemem(buf[sectors*size:], addr+sectors*size)
-
-    def readbuf(self, addr=0x08000000, length=MAX_BUF_SIZE):
-        idx, remain = divmod(length, MAX_BUF_SIZE)
-        buf = b''
-        prog = LocalBar('Read image: ')
-        for i in prog(range(idx)):
-            buf += self.readmem(addr + MAX_BUF_SIZE*i, MAX_BUF_SIZE)
-        if remain:
-            buf += self.readmem(addr+MAX_BUF_SIZE*idx, remain)
+        view = memoryview(buf)
+        prog = LocalBar('Writing image: ') if progress else iter
+        self.link.reset_stats()
+        for off in prog(range(0, len(view), size)):
+            block = view[off: off+size]
+            if skip_blank and firmware.is_blank(block):
+                continue
+            self.retry(self.writemem, block, addr+off)
+        if progress:
+            print('write speed: {:.1f} KB/s'.format(self.link.rate() / 1024))
+
+    def writeimage(self, fw, progress=True, skip_blank=True, journal=None, report=None):
+        # write the populated ranges of a sparse image, blocks which are
+        # all 0xFF are left alone since the flash is erased already, and
+        # blocks in the journal were written by an interrupted session.
+        # report(done, total) is called with the bytes after every block
+        blocks = [(addr, block) for addr, block in fw.blocks(MAX_BUF_SIZE, skip_blank)
+                  if journal is None or addr not in journal]
+        total = sum(len(block) for _, block in blocks)
+        done = 0
+        prog = LocalBar('Writing image: ') if progress else iter
+        self.link.reset_stats()
+        for addr, block in prog(blocks):
+            self.retry(self.writemem, block, addr)
+            if journal is not None:
+                journal.add(addr)
+            done += len(block)
+            if report:
+                report(done, total)
+        if journal is not None:
+            journal.finish()
+        if progress:
+            print('write {} of {} bytes, speed: {:.1f} KB/s'.format(
+                total, fw.size, self.link.rate() / 1024))
+
+    def layout(self):
+        if self.id not in CHIPS:
+            raise Exception('unknown flash layout of chip: {}'.format(hex(self.id)))
+        return CHIPS[self.id]
+
+    def coversectors(self, addr, length):
+        # the (index, address, size) of every sector the range touches
+        chip = self.layout()
+        if addr < chip.base or addr + length > chip.base + chip.flash:
+            raise Exception('image is out of flash: {}'.format(hex(addr)))
+        sectors = []
+        idx, base = 0, chip.base
+        for count, size in chip.sectors:
+            for _ in range(count):
+                if base < addr + length and base + size > addr:
+                    sectors.append((idx, base, size))
+                idx += 1
+                base += size
+        return sectors
+
+    def erasesectors(self, sectors):
+        numbers = [idx for idx, _, _ in sectors]
+        for i in range(0, len(numbers), MAX_ERASE_PAGES):
+            self.erasemem(pages=numbers[i: i+MAX_ERASE_PAGES])
+
+    def imagesectors(self, fw):
+        sectors = {}
+        for addr, length in fw.ranges():
+            for sector in self.coversectors(addr, length):
+                sectors[sector[0]] = sector
+        return [sectors[idx] for idx in sorted(sectors)]
+
+    def erasable(self, sectors):
+        # legacy erase takes page numbers up to 0xFF only
+        return not sectors or EERASEM in (self.cmd or []) or sectors[-1][0] <= 0xFF
+
+    def eraseimage(self, fw):
+        # erase only the sectors the image covers, fall back to a mass
+        # erase when the layout is unknown or legacy erase can not do it
+        if self.id not in CHIPS:
+            self.erasemem(True)
+            return
+        sectors = self.imagesectors(fw)
+        if not self.erasable(sectors):
+            self.erasemem(True)
+        else:
+            self.erasesectors(sectors)
+
+    def diffsectors(self, fw):
+        # read back every sector covered by the image and merge the image
+        # into it, returns the merged sectors which differ from the flash
+        sectors = []
+        prog = LocalBar('Compare image: ')
+        for idx, base, size in prog(self.imagesectors(fw)):
+            old = self.readbuf(base, size, progress=False)
+            new = fw.overlay(bytearray(old), base)
+            if new != old:
+                sectors.append((idx, base, new))
+        return sectors
+
+    def writedelta(self, fw):
+        last = self.imagesectors(fw)[-1:]
+        if not self.erasable(last):
+            raise IspError('page {} can not be erased by legacy erase, write the whole image'.format(last[0][0]))
+        sectors = self.diffsectors(fw)
+        if not sectors:
+            print('flash is up to date')
+            return 0
+        self.erasesectors(sectors)
+        prog = LocalBar('Writing sectors: ')
+        for _, base, data in prog(sectors):
+            self.writebin(data, base, progress=False, skip_blank=True)
+        print('{} of {} sectors changed'.format(len(sectors), len(self.imagesectors(fw))))
+        return len(sectors)
+
+    def readinto(self, buf, addr=0x08000000, progress=True):
+        view = memoryview(buf)
+        prog = LocalBar('Read image: ') if progress else iter
+        self.link.reset_stats()
+        for off in prog(range(0, len(view), MAX_BUF_SIZE)):
+            self.retry(self.readmeminto, view[off: off+MAX_BUF_SIZE], addr+off)
+        if progress:
+            print('read speed: {:.1f} KB/s'.format(self.link.rate() / 1024))
+        return len(view)
+
+    def readbuf(self, addr=0x08000000, length=MAX_BUF_SIZE, progress=True):
+        buf = bytearray(length)
+        self.readinto(buf, addr, progress)
         return buf
 
+    def readfile(self, fileobj, addr=0x08000000, length=MAX_BUF_SIZE, progress=True):
+        # stream the flash to a file object through a single block buffer
+        view = memoryview(bytearray(MAX_BUF_SIZE))
+        prog = LocalBar('Read image: ') if progress else iter
+        self.link.reset_stats()
+        for off in prog(range(0, length, MAX_BUF_SIZE)):
+            block = view[:min(MAX_BUF_SIZE, length - off)]
+            self.retry(self.readmeminto, block, addr+off)
+            fileobj.write(block)
+        if progress:
+            print('read speed: {:.1f} KB/s'.format(self.link.rate() / 1024))
+        return length
+
     def __del__(self):
-        if self.dev:
+        if getattr(self, 'dev', None):
             self.dev.close()
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', '--port', type=str, help='serial device name')
-    parser.add_argument('input', type=argparse.FileType(mode='rb'), help='the image binary for downloading')
+    parser.add_argument('input', type=argparse.FileType(mode='rb'), help='the image for downloading: binary, intel hex, elf or dfu')
     parser.add_argument('-o', '--output', type=argparse.FileType(mode='wb'), help='the image binary read from flash')
     parser.add_argument('-l', '--len', type=int, help='length of the image binary read from flash')
     parser.add_argument('-b', '--bps', default=460800, choices=BPS, type=int, help='the image binary read from flash')
+    parser.add_argument('-B', '--auto-bps', action='store_true', default=False, help='find the fastest working baudrate and cache it')
+    parser.add_argument('-R', '--reset', choices=('dtr', 'rts'), help='serial line wired to the board reset for auto baudrate')
     parser.add_argument('-p', '--info', action='store_true', default=True, help='boards info')
     parser.add_argument('-c', '--com', action='store_true', help='supportted command list')
     parser.add_argument('-e', '--exe', action='store_true', default=True, help='start running board')
     parser.add_argument('-a', '--addr', type=int, default=0x08000000, help='supportted command list')
     parser.add_argument('-u', '--unprotect', action='store_true', default=False, help='readout unprotect')
+    parser.add_argument('-P', '--pipeline', action='store_true', default=False, help='send all phases of a command without waiting for each ack')
+    parser.add_argument('-m', '--mass', action='store_true', default=False, help='mass erase instead of erasing the image sectors')
+    parser.add_argument('-r', '--retry', type=int, default=3, help='retries of every block on NACK or timeout')
+    single = parser.add_mutually_exclusive_group()
+    single.add_argument('-j', '--journal', type=str, help='journal file of written blocks, resume from it when it exists')
+    single.add_argument('-L', '--loader', type=argparse.FileType(mode='rb'), help='helper loaded into sram to write the flash in large blocks')
+    parser.add_argument('--loader-addr', type=lambda x: int(x, 0), default=0x20001000, help='sram address of the helper')
+    parser.add_argument('--loader-bps', type=int, default=921600, help='baudrate of the helper')
+    single.add_argument('-D', '--delta', action='store_true', default=False, help='only erase and write the changed pages')
     args = parser.parse_args()
     devs = list_ports.comports()
+    boots = []
     if not args.port:
+        boots = discover([port.device for port in devs], args.bps)
+        if boots:
+            devs = boots
+            for i, boot in enumerate(boots):
+                chip = CHIPS[boot.id].name if boot.id in CHIPS else 'Unknown'
+                print('{}. {}\t {}, bootloader version: {}.'.format(i, boot.port, chip, boot.version))
         if not devs:
             print('Please connect your board using serial')
             exit()
         elif len(devs) == 1:
             num = 0
         else:
-            for i, port in enumerate(devs):
-                print('{}. {}\t {}.'.format(i, port.device, port.description))
+            if not boots:
+                for i, port in enumerate(devs):
+                    print('{}. {}\t {}.'.format(i, port.device, port.description))
             try:
                 num = int(input('Plase enter a number to select device: [0]'))
             except:
                 num = 0
 
         if num >= 0 and num < len(devs):
-            args.port = devs[num].device
+            args.port = devs[num].port if boots else devs[num].device
         else:
             print('Your input is incorrect!')
             exit()
@@ -290,8 +810,14 @@ def main():
             print('Your input is incorrect!')
             exit()
 
-    board = Isp(args.port, args.bps)
-    board.init()
+    if args.auto_bps:
+        board = autobaud(args.port, args.reset, pipeline=args.pipeline, retries=args.retry)
+        if not board:
+            print('Can not find a working baudrate')
+            exit()
+    else:
+        board = Isp(args.port, args.bps, pipeline=args.pipeline, retries=args.retry)
+        board.init(synced=bool(boots))
 
     if args.info:
         board.info()
@@ -305,21 +831,60 @@ def main():
 
     if args.output:
         if args.len:
-            args.output.write(board.readbuf(args.addr, args.len))
+            board.readfile(args.output, args.addr, args.len)
         else:
             print('Please spec the length of read using <-l lens>')
             exit()
 
     if args.input:
+        image = firmware.load(args.input, args.addr)
+        if not image.segments:
+            print('The image is empty')
+            exit()
+
+    journal = Journal(args.journal, image) if args.input and args.journal else None
+
+    if args.input and args.loader:
+        from .fastload import FastLoader
+        fast = FastLoader(board, args.loader.read(), args.loader_addr)
+        fast.start(args.loader_bps)
+        if args.mass:
+            chip = board.layout()
+            fast.erase(board.coversectors(chip.base, chip.flash))
+        else:
+            fast.erase(board.imagesectors(image))
+        fast.writeimage(image)
+        fast.verify(image)
+        if args.exe:
+            fast.go(image.start)
+        exit()
+
+    if args.input and args.delta:
         try:
-            board.erasemem(True)
-        except:
-            print('Please try unprotect readout using "-u"')
+            board.writedelta(image)
+        except Exception as e:
+            print(e)
             exit()
-        board.writebin(args.input.read(), args.addr)
+    elif args.input:
+        if journal:
+            print('resume, {} blocks already written'.format(len(journal)))
+        else:
+            try:
+                if args.mass:
+                    board.erasemem(True)
+                else:
+                    board.eraseimage(image)
+            except IspError:
+                # a NACK, the flash is read out protected
+                print('Please try unprotect readout using "-u"')
+                exit()
+            except Exception as e:
+                print(e)
+                exit()
+        board.writeimage(image, journal=journal)
 
     if args.input and args.exe:
-        board.go(args.addr)
+        board.go(image.start)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,96 @@
+import argparse
+import json
+import os
+import time
+
+from .isp import CHIPS, MAX_BUF_SIZE, Isp
+from . import firmware
+from .ispemu import IspEmulator
+
+
+def timeit(func, rounds):
+    # seconds of every call
+    times = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def latency(times):
+    times = sorted(times)
+    return {
+        'mean_ms': round(sum(times) / len(times) * 1000, 3),
+        'p50_ms': round(times[len(times) // 2] * 1000, 3),
+        'max_ms': round(times[-1] * 1000, 3),
+    }
+
+
+def bench_commands(board, base, rounds):
+    block = os.urandom(MAX_BUF_SIZE)
+    addrs = iter(range(base, base + rounds * MAX_BUF_SIZE, MAX_BUF_SIZE))
+    return {
+        'getid': latency(timeit(board.getId, rounds)),
+        'readmem': latency(timeit(lambda: board.readmem(base, MAX_BUF_SIZE), rounds)),
+        'writemem': latency(timeit(lambda: board.writemem(block, next(addrs)), rounds)),
+    }
+
+
+def bench_transfer(board, base, size):
+    fw = firmware.load_bin(os.urandom(size), base)
+    board.eraseimage(fw)
+    start = time.perf_counter()
+    board.writeimage(fw, progress=False, skip_blank=False)
+    write = time.perf_counter() - start
+    start = time.perf_counter()
+    data = board.readbuf(base, size, progress=False)
+    read = time.perf_counter() - start
+    if data != fw.segments[0][1]:
+        raise Exception('read back is not the written image')
+    return {
+        'write_Bps': round(size / write),
+        'read_Bps': round(size / read),
+    }
+
+
+def run(chip=0x413, size=0x10000, rounds=100, latency=0.0, bps=None, pipeline=(False, True)):
+    results = {'chip': hex(chip), 'size': size, 'latency': latency, 'bps': bps, 'runs': []}
+    for pipe in pipeline:
+        with IspEmulator(chip, latency=latency, bps=bps) as emu:
+            board = Isp(emu.port, bps or 460800, timeout=2, pipeline=pipe, parity=emu.parity)
+            board.verbose = False
+            board.init()
+            base = CHIPS[chip].base
+            run = {'pipeline': pipe}
+            run.update(bench_transfer(board, base, size))
+            run['commands'] = bench_commands(board, base + size, rounds)
+            board.dev.close()
+            board.dev = None
+        results['runs'].append(run)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--chip', type=lambda x: int(x, 0), default=0x413, help='emulated chip id')
+    parser.add_argument('-s', '--size', type=lambda x: int(x, 0), default=0x10000, help='bytes written and read back')
+    parser.add_argument('-n', '--rounds', type=int, default=100, help='calls of every command')
+    parser.add_argument('-l', '--latency', type=float, default=0.0, help='emulated seconds before every reply')
+    parser.add_argument('-b', '--bps', type=int, help='emulated link baudrate')
+    parser.add_argument('-j', '--json', type=argparse.FileType(mode='w'), help='write the results as json')
+    args = parser.parse_args()
+
+    results = run(args.chip, args.size, args.rounds, args.latency, args.bps)
+    for r in results['runs']:
+        print('pipeline: {}'.format(r['pipeline']))
+        print('  writebin: {:.1f} KB/s  readbuf: {:.1f} KB/s'.format(
+            r['write_Bps'] / 1024, r['read_Bps'] / 1024))
+        for name, lat in r['commands'].items():
+            print('  {:<10} mean {mean_ms:.3f} ms  p50 {p50_ms:.3f} ms  max {max_ms:.3f} ms'.format(name, **lat))
+    if args.json:
+        json.dump(results, args.json, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,323 @@
+import argparse
+import os
+import pty
+import random
+import select
+import struct
+import termios
+import threading
+import time
+import tty
+from functools import reduce
+from operator import xor
+
+from .isp import (ACK, CHIPS, EERASEM, ERASEM, GETCMD, GETID, GETVER, GOCMD, INIT, NACK,
+                  READM, READPC, READUPC, WRITEM, WRITEPC, WRITEUPC)
+from .fastload import (FAST_CRC, FAST_ERASE, FAST_GO, FAST_HEADER, FAST_SYNC, FAST_WRITE,
+                       crc32)
+
+# baudrate of every termios speed
+SPEEDS = dict((getattr(termios, 'B{}'.format(bps)), bps) for bps in
+              (9600, 19200, 38400, 57600, 115200, 230400, 460800, 921600) if hasattr(termios, 'B{}'.format(bps)))
+
+RAM_BASE = 0x20000000
+RAM_SIZE = 0x20000
+
+
+class Stopped(Exception):
+    pass
+
+
+class IspEmulator(object):
+    # an AN3155 usart bootloader on a pseudo terminal, open self.port with
+    # Isp like a real board. latency is added before every reply and
+    # nack_rate is the chance that a write or read command is NACKed.
+    # With fast, a GO to SRAM runs the helper of stm32tool.fastload.
+    # A pseudo terminal has no parity bit and refuses to set one once it
+    # was opened, so open it with parity=emu.parity. With max_bps a host
+    # opening the port faster than that makes the bootloader lock on a
+    # wrong baudrate, like a bad link does, and a bootloader only takes
+    # the baudrate it synced at until reset() is called.
+    def __init__(self, chip_id=0x413, version=0x31, extended=None, latency=0.0,
+                 nack_rate=0.0, bps=None, seed=None, fast=True, max_bps=None):
+        chip = CHIPS[chip_id]
+        self.chip_id = chip_id
+        self.chip = chip
+        self.version = version
+        self.extended = bool(chip.flash > 0x80000) if extended is None else extended
+        self.latency = latency
+        self.nack_rate = nack_rate
+        self.bps = bps
+        self.max_bps = max_bps
+        self.flash = bytearray(b'\xff') * chip.flash
+        self.ram = bytearray(RAM_SIZE)
+        self.go_addr = None
+        # going to SRAM starts the fast loader stage of stm32tool.fastload
+        self.fast = fast
+        self._fast = False
+        self.stats = {}
+        self._random = random.Random(seed)
+        self._synced = False
+        self._locked = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._master)
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self.parity = 'N'
+
+    @property
+    def cmds(self):
+        erase = EERASEM if self.extended else ERASEM
+        return [GETCMD, GETVER, GETID, READM, GOCMD, WRITEM, erase,
+                WRITEPC, WRITEUPC, READPC, READUPC]
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def _read(self, num):
+        data = b''
+        while len(data) < num:
+            ready, _, _ = select.select([self._master], [], [], 0.1)
+            if self._stop.is_set():
+                raise Stopped()
+            if ready:
+                data += os.read(self._master, num - len(data))
+        if self.bps:
+            time.sleep(num * 11.0 / self.bps)
+        return data
+
+    def _send(self, data):
+        if self.latency:
+            time.sleep(self.latency)
+        if self.bps:
+            # 8E1 framing, 11 bits every byte
+            time.sleep(len(data) * 11.0 / self.bps)
+        os.write(self._master, bytes(data))
+
+    def _readframe(self, num):
+        # num bytes followed by their xor checksum
+        data = self._read(num + 1)
+        return data[:-1], reduce(xor, data[:-1], 0) == data[-1]
+
+    def _memory(self, addr, length):
+        if self.chip.base <= addr and addr + length <= self.chip.base + self.chip.flash:
+            return self.flash, addr - self.chip.base
+        if RAM_BASE <= addr and addr + length <= RAM_BASE + RAM_SIZE:
+            return self.ram, addr - RAM_BASE
+        return None, 0
+
+    def _readaddr(self):
+        data, ok = self._readframe(4)
+        if not ok:
+            self._send([NACK])
+            return None
+        self._send([ACK])
+        return int.from_bytes(data, 'big')
+
+    def _inject(self):
+        return self.nack_rate and self._random.random() < self.nack_rate
+
+    def _sectors(self):
+        base = self.chip.base
+        for count, size in self.chip.sectors:
+            for _ in range(count):
+                yield base - self.chip.base, size
+                base += size
+
+    def erase(self, pages=None):
+        if pages is None:
+            self.flash[:] = b'\xff' * len(self.flash)
+            return
+        sectors = list(self._sectors())
+        for page in pages:
+            offset, size = sectors[page]
+            self.flash[offset: offset + size] = b'\xff' * size
+
+    def _serve(self):
+        try:
+            while not self._stop.is_set():
+                if self._fast:
+                    self._serve_fast()
+                    continue
+                if not self._synced:
+                    if self._read(1)[0] == INIT and self._locked is None:
+                        self._locked = self.host_bps()
+                        if not self.max_bps or self._locked <= self.max_bps:
+                            self._synced = True
+                            self._send([ACK])
+                    continue
+                cmd, check = self._read(2)
+                if self.max_bps and self.host_bps() != self._locked:
+                    # sent at another baudrate, garbage to the bootloader
+                    continue
+                if cmd ^ check != 0xFF or cmd not in self.cmds:
+                    self._send([NACK])
+                    continue
+                self.stats[cmd] = self.stats.get(cmd, 0) + 1
+                self._send([ACK])
+                handler = getattr(self, '_cmd_{:02x}'.format(cmd), None)
+                if handler:
+                    handler()
+                else:
+                    self._send([ACK])
+        except (Stopped, OSError):
+            pass
+
+    def host_bps(self):
+        # the baudrate the host set on the port
+        speed = termios.tcgetattr(self._slave)[5]
+        return SPEEDS.get(speed, 0)
+
+    def reset(self):
+        # the reset line of the board, the bootloader waits for a sync
+        # byte again and measures its baudrate
+        self._synced = False
+        self._locked = None
+        self._fast = False
+
+    def _cmd_00(self):
+        cmds = self.cmds
+        self._send([len(cmds), self.version] + cmds + [ACK])
+
+    def _cmd_01(self):
+        self._send([self.version, 0, 0, ACK])
+
+    def _cmd_02(self):
+        self._send([1, (self.chip_id >> 8) & 0xFF, self.chip_id & 0xFF, ACK])
+
+    def _cmd_11(self):
+        addr = self._readaddr()
+        if addr is None:
+            return
+        length, check = self._read(2)
+        mem, offset = self._memory(addr, length + 1)
+        if length ^ check != 0xFF or mem is None or self._inject():
+            self._send([NACK])
+            return
+        self._send(bytes([ACK]) + mem[offset: offset + length + 1])
+
+    def _cmd_21(self):
+        addr = self._readaddr()
+        if addr is not None:
+            self.go_addr = addr
+            self._synced = False
+            self.go(addr)
+
+    def go(self, addr):
+        if self.fast and RAM_BASE <= addr < RAM_BASE + RAM_SIZE:
+            self._fast = True
+
+    def _serve_fast(self):
+        cmd, arg, length = FAST_HEADER.unpack(self._read(FAST_HEADER.size))
+        if cmd == FAST_SYNC:
+            self._send([ACK])
+        elif cmd == FAST_WRITE:
+            data = self._read(length + 4)
+            data, crc = data[:-4], struct.unpack('<I', data[-4:])[0]
+            mem, offset = self._memory(arg, length)
+            if mem is not self.flash or crc32(data) != crc or self._inject():
+                self._send([NACK])
+                return
+            for i, val in enumerate(data):
+                mem[offset + i] &= val
+            self._send([ACK])
+        elif cmd == FAST_CRC:
+            mem, offset = self._memory(arg, length)
+            if mem is None:
+                self._send([NACK])
+                return
+            self._send(bytes([ACK]) + struct.pack('<I', crc32(mem[offset: offset + length])))
+        elif cmd == FAST_ERASE:
+            self.erase([arg])
+            self._send([ACK])
+        elif cmd == FAST_GO:
+            self._send([ACK])
+            self.go_addr = arg
+            self._fast = False
+        else:
+            self._send([NACK])
+
+    def _cmd_31(self):
+        addr = self._readaddr()
+        if addr is None:
+            return
+        length = self._read(1)[0]
+        data = self._read(length + 2)
+        data, ok = data[:-1], reduce(xor, data[:-1], length) == data[-1]
+        mem, offset = self._memory(addr, len(data))
+        if not ok or mem is None or addr % 4 or self._inject():
+            self._send([NACK])
+            return
+        if mem is self.flash:
+            # programming can only clear bits
+            for i, val in enumerate(data):
+                mem[offset + i] &= val
+        else:
+            mem[offset: offset + len(data)] = data
+        self._send([ACK])
+
+    def _cmd_43(self):
+        num = self._read(1)[0]
+        if num == 0xFF:
+            self._read(1)
+            self.erase()
+        else:
+            data = self._read(num + 2)
+            pages = data[:-1]
+            if reduce(xor, pages, num) != data[-1]:
+                self._send([NACK])
+                return
+            self.erase(list(pages))
+        self._send([ACK])
+
+    def _cmd_44(self):
+        head = self._read(2)
+        num = int.from_bytes(head, 'big')
+        if num >= 0xFFF0:
+            self._read(1)
+            self.erase()
+        else:
+            data = self._read((num + 1) * 2 + 1)
+            if reduce(xor, head + data, 0):
+                self._send([NACK])
+                return
+            self.erase([int.from_bytes(data[i: i + 2], 'big') for i in range(0, len(data) - 1, 2)])
+        self._send([ACK])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--chip', type=lambda x: int(x, 0), default=0x413, help='chip id')
+    parser.add_argument('-l', '--latency', type=float, default=0.0, help='seconds before every reply')
+    parser.add_argument('-n', '--nack', type=float, default=0.0, help='chance of a NACKed read or write')
+    parser.add_argument('-b', '--bps', type=int, help='simulated link baudrate')
+    args = parser.parse_args()
+    emu = IspEmulator(args.chip, latency=args.latency, nack_rate=args.nack, bps=args.bps)
+    print('stm32 bootloader emulator on: {}'.format(emu.port))
+    emu.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        emu.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,20 @@
+import heapq
+import io
+import itertools
+import os
+import select
 import struct
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
 import serial
 from serial import SerialException
 from serial.tools import list_ports
 import numpy as np
 from PIL import Image
 import threading
-lock = threading.Lock()
 
 # USB Debug commands
 USBDBG_CMD              = 48
@@ -38,27 +47,322 @@ BOOTLDR_WRITE           = 0xABCD0008
 BOOTLDR_FLASH           = 0xABCD0010
 
 
+_RGB565_LUT = None
+
+
+def rgb565_lut():
+    # RGB888 of every RGB565 pixel, indexed by the two bytes of the big
+    # endian pixel read as a native uint16, so no byte swap is needed
+    global _RGB565_LUT
+    if _RGB565_LUT is None:
+        raw = np.arange(0x10000, dtype=np.uint32)
+        pixel = ((raw & 0xFF) << 8) | (raw >> 8) if np.little_endian else raw
+        lut = np.empty((0x10000, 3), dtype=np.uint8)
+        lut[:, 0] = ((pixel >> 11) & 0x1F) * 255 // 31
+        lut[:, 1] = ((pixel >> 5) & 0x3F) * 255 // 63
+        lut[:, 2] = (pixel & 0x1F) * 255 // 31
+        _RGB565_LUT = lut
+    return _RGB565_LUT
+
+
+_index = threading.local()
+
+
+def rgb565_index(count):
+    # an intp buffer of count pixels for every thread, np.take would cast
+    # the uint16 pixels into a new one on every frame
+    buffers = getattr(_index, 'buffers', None)
+    if buffers is None:
+        buffers = _index.buffers = {}
+    index = buffers.get(count)
+    if index is None:
+        index = buffers[count] = np.empty(count, dtype=np.intp)
+    return index
+
+
+def decode_rgb565(buff, out):
+    pixels = np.frombuffer(buff, dtype=np.uint16)
+    index = rgb565_index(len(pixels))
+    index[:] = pixels
+    # with mode raise np.take fills a copy of out and copies it back
+    np.take(rgb565_lut(), index, axis=0, out=out.reshape(-1, 3), mode='clip')
+    return out
+
+
+def decode_gray(buff, out):
+    y = np.frombuffer(buff, dtype=np.uint8)
+    out.reshape(-1, 3)[:] = y[:, np.newaxis]
+    return out
+
+
+# formats of the frame payload sent by the camera
+FB_GRAY = 'GRAY'
+FB_RGB565 = 'RGB565'
+FB_JPEG = 'JPEG'
+
+
+def frame_format(size):
+    # the third field of a frame size reply is the bytes per pixel, or the
+    # length of the JPEG data
+    return {1: FB_GRAY, 2: FB_RGB565}.get(size[2], FB_JPEG)
+
+
+class Frame(object):
+    # a frame as sent by the camera, nothing is decoded until a view is
+    # asked for and every view is decoded once. Storing or forwarding the
+    # payload never pays for a decode.
+    def __init__(self, width, height, format, data, timestamp=None):
+        self.width = width
+        self.height = height
+        self.format = format
+        self.data = data
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self._rgb = None
+        self._gray = None
+        self._image = None
+        self._jpeg = None
+
+    @classmethod
+    def from_size(cls, size, data, timestamp=None):
+        return cls(size[0], size[1], frame_format(size), data, timestamp)
+
+    @property
+    def size(self):
+        return (self.width, self.height)
+
+    @property
+    def nbytes(self):
+        return len(self.data)
+
+    def __repr__(self):
+        return '<Frame {}x{} {} {} bytes>'.format(self.width, self.height, self.format, self.nbytes)
+
+    def __getstate__(self):
+        # for process pools: the payload as bytes, no decoded views
+        return (self.width, self.height, self.format, self.tobytes(), self.timestamp)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def tobytes(self):
+        return bytes(self.data)
+
+    def rgb(self, out=None):
+        # (h, w, 3) RGB888 array, decoded into out when given
+        if self._rgb is not None and out is None:
+            return self._rgb
+        if out is None:
+            out = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        if self.format == FB_GRAY:
+            decode_gray(self.data, out)
+        elif self.format == FB_RGB565:
+            decode_rgb565(self.data, out)
+        else:
+            rgb = np.asarray(self.image().convert('RGB'))
+            if rgb.shape != out.shape:
+                raise ValueError('JPEG frame is {}x{}, expected {}x{}'.format(
+                    rgb.shape[1], rgb.shape[0], self.width, self.height))
+            out[:] = rgb
+        self._rgb = out
+        return out
+
+    def gray(self):
+        # (h, w) luma array, a view of the payload for grayscale frames
+        if self._gray is None:
+            if self.format == FB_GRAY:
+                gray = np.frombuffer(self.data, dtype=np.uint8)
+                self._gray = gray.reshape((self.height, self.width))
+            elif self.format == FB_JPEG and self._rgb is None:
+                # the JPEG decoder gives the luma plane without color conversion
+                image = Image.open(io.BytesIO(self.data))
+                image.draft('L', image.size)
+                self._gray = np.asarray(image.convert('L'))
+            else:
+                rgb = self.rgb().astype(np.uint16)
+                gray = (rgb[..., 0] * 77 + rgb[..., 1] * 150 + rgb[..., 2] * 29) >> 8
+                self._gray = gray.astype(np.uint8)
+        return self._gray
+
+    def image(self):
+        # PIL image of the frame
+        if self._image is None:
+            if self.format == FB_GRAY:
+                self._image = Image.frombuffer('L', self.size, self.data, 'raw', 'L', 0, 1)
+            elif self.format == FB_RGB565:
+                self._image = Image.fromarray(self.rgb())
+            else:
+                image = Image.open(io.BytesIO(self.data))
+                image.load()
+                self._image = image
+        return self._image
+
+    def jpeg(self, quality=90):
+        # JPEG bytes of the frame, camera JPEG is passed through as is
+        if self._jpeg is None:
+            if self.format == FB_JPEG:
+                self._jpeg = self.tobytes()
+            else:
+                out = io.BytesIO()
+                self.image().save(out, 'JPEG', quality=quality)
+                self._jpeg = out.getvalue()
+        return self._jpeg
+
+    def draft(self, scale):
+        # RGB888 array reduced by scale (2, 4 or 8) for previews, not
+        # cached. JPEG frames are decoded at the reduced size, raw frames
+        # only look up the kept pixels.
+        if scale <= 1:
+            return self.rgb()
+        if self.format == FB_JPEG:
+            image = Image.open(io.BytesIO(self.data))
+            image.draft('RGB', (self.width // scale, self.height // scale))
+            return np.asarray(image.convert('RGB'))
+        dtype = np.uint8 if self.format == FB_GRAY else np.uint16
+        pixels = np.frombuffer(self.data, dtype=dtype).reshape((self.height, self.width))
+        pixels = pixels[::scale, ::scale]
+        if self.format == FB_GRAY:
+            return np.repeat(pixels[..., np.newaxis], 3, axis=2)
+        return np.take(rgb565_lut(), pixels, axis=0)
+
+
+def get_openmv_ports():
+    # every attached camera, the usb serial number tells them apart
+    return [port for port in list_ports.comports() if 'OpenMV' in port.description]
+
+
 def get_openmv_port():
-    for port in list_ports.comports():
-        if 'OpenMV' in port.description:
-            return port.device
+    for port in get_openmv_ports():
+        return port.device
     return None
 
 
-def lock_func(func):
-    def decorator(*args, **kwargs):
-        with lock:
-            result = func(*args, **kwargs)
-        return result
-    return decorator
+class BufferPool(object):
+    # reusable receive buffers keyed by size, a JPEG frame gets a buffer of
+    # the next bucket size so frames of varying size share buffers
+    BUCKET = 0x4000
+
+    def __init__(self, depth=4, buckets=8):
+        self.depth = depth
+        self.buckets = buckets
+        self._free = {}
+        self._lock = threading.Lock()
+
+    def get(self, size, exact=True):
+        key = size if exact else -(-size // self.BUCKET) * self.BUCKET
+        with self._lock:
+            free = self._free.get(key)
+            buf = free.pop() if free else None
+        if buf is None:
+            buf = bytearray(key)
+        return memoryview(buf)[:size]
+
+    def put(self, view):
+        buf = view.obj
+        with self._lock:
+            free = self._free.setdefault(len(buf), [])
+            if len(free) < self.depth:
+                free.append(buf)
+            while len(self._free) > self.buckets:
+                del self._free[next(iter(self._free))]
+
+
+# per frame timing of fb_stream in seconds: waiting for the frame size,
+# reading the frame data, decoding, and time since the previous frame
+FrameTiming = namedtuple('FrameTiming', 'seq size transfer decode interval')
+
+
+# command priorities of the Scheduler
+CMD_CONTROL = 0
+CMD_BULK = 1
+
+
+class Scheduler(object):
+    # orders the request/response pairs of one camera: one command owns the
+    # port from its request to the end of its reply, waiting control
+    # commands go before waiting frame dumps, FIFO otherwise. The owner
+    # thread may enter again, fb_dump asks fb_size.
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._owner = None
+        self._depth = 0
+        self._waiting = []
+        self._tickets = itertools.count()
+
+    def acquire(self, priority=CMD_CONTROL):
+        me = threading.get_ident()
+        with self._cond:
+            if self._owner == me:
+                self._depth += 1
+                return
+            entry = (priority, next(self._tickets))
+            heapq.heappush(self._waiting, entry)
+            while self._owner is not None or self._waiting[0] != entry:
+                self._cond.wait()
+            heapq.heappop(self._waiting)
+            self._owner = me
+            self._depth = 1
+
+    def release(self):
+        with self._cond:
+            self._depth -= 1
+            if not self._depth:
+                self._owner = None
+                self._cond.notify_all()
+
+    @property
+    def waiting(self):
+        with self._cond:
+            return len(self._waiting)
+
+    @contextmanager
+    def command(self, priority=CMD_CONTROL):
+        self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+def command(priority):
+    def wrap(func):
+        def decorator(self, *args, **kwargs):
+            with self.scheduler.command(priority):
+                # a frame size query of fb_stream may still be in flight
+                self._drain()
+                return func(self, *args, **kwargs)
+        return decorator
+    return wrap
+
+
+lock_func = command(CMD_CONTROL)
+bulk_func = command(CMD_BULK)
 
 
 class OpenMV(object):
-    def __init__(self, *args):
+    def __init__(self, *args, port=None):
         self._serial = None
         self._fw_version = None
         self._connect = False
-        self._port = get_openmv_port()
+        self._port = port or get_openmv_port()
+        self.scheduler = Scheduler()
+        # decoded frames of every resolution, reused by fb_dump
+        self._frames = {}
+        self._size_pending = False
+        self._size_buf = bytearray(12)
+        # (size, buffer, time) of a frame read by _drain
+        self._drained = None
+        self.pool = BufferPool()
+        self.short_reads = 0
+        self.rx_bytes = 0
+        # capture time of the last frame read
+        self.frame_time = None
+        # decode workers of fb_stream update these under the lock, the
+        # message of the last failed decode is kept in decode_error
+        self.decode_time = 0.0
+        self.decode_errors = 0
+        self.decode_error = None
+        self._decode_lock = threading.Lock()
+        self.timings = deque(maxlen=100)
         super(OpenMV, self).__init__(*args)
 
     def __del__(self):
@@ -90,6 +394,7 @@ class OpenMV(object):
                 pass
 
     @property
+    @lock_func
     def fw_version(self):
         if not self._fw_version:
             self._serial.write(struct.pack("<BBI", USBDBG_CMD, USBDBG_FW_VERSION, 12))
@@ -99,9 +404,71 @@ class OpenMV(object):
         return self._fw_version
 
     @property
+    @lock_func
     def fb_size(self):
+        self._fb_size_request()
+        return self._fb_size_reply()
+
+    def _fb_size_request(self):
         self._serial.write(struct.pack("<BBI", USBDBG_CMD, USBDBG_FRAME_SIZE, 12))
-        return struct.unpack("<3I", self._serial.read(12))
+        self._size_pending = True
+
+    def _fb_size_reply(self):
+        self._size_pending = False
+        if self._readinto(self._size_buf) != 12:
+            self._short_read()
+            return (0, 0, 0)
+        return struct.unpack("<3I", self._size_buf)
+
+    def _recv(self, view):
+        fd = getattr(self._serial, 'fd', None)
+        if fd is None or not hasattr(os, 'readv'):
+            return self._serial.readinto(view)
+        # straight into the buffer, pyserial would allocate every read
+        ready, _, _ = select.select([fd], [], [], self._serial.timeout)
+        if not ready:
+            return 0
+        try:
+            return os.readv(fd, [view])
+        except BlockingIOError:
+            return 0
+
+    def _readinto(self, buf):
+        # fill the whole buffer, a read cut by the port timeout goes on as
+        # long as data keeps coming
+        view = memoryview(buf)
+        got = 0
+        while got < len(view):
+            num = self._recv(view[got:])
+            if not num:
+                break
+            got += num
+        return got
+
+    def _short_read(self):
+        # the rest of a cut reply would be taken for the next one
+        self.short_reads += 1
+        time.sleep(0.05)
+        self._serial.reset_input_buffer()
+
+    def _drain(self):
+        # a non zero frame size holds the frame buffer lock of the camera
+        # until the frame is dumped, so the frame of a size query in flight
+        # is read and kept for the next fb_dump or fb_stream step
+        if self._size_pending and self._serial:
+            size = self._fb_size_reply()
+            buff = self._fb_read(size)
+            if buff is not None:
+                if self._drained is not None:
+                    self.pool.put(self._drained[1])
+                self._drained = (size, buff, self.frame_time)
+
+    def _take_drained(self):
+        if self._drained is None:
+            return None
+        size, buff, self.frame_time = self._drained
+        self._drained = None
+        return size, buff
 
     @lock_func
     def exec_script(self, buf):
@@ -112,13 +479,31 @@ class OpenMV(object):
     def stop_script(self):
         self._serial.write(struct.pack("<BBI", USBDBG_CMD, USBDBG_SCRIPT_STOP, 0))
 
+    @lock_func
     def fb_enable(self, enable):
         self._serial.write(struct.pack("<BBIH", USBDBG_CMD, USBDBG_FB_ENABLE, 0, enable))
 
-    @lock_func
-    def fb_dump(self):
-        size = self.fb_size
+    @bulk_func
+    def fb_dump(self, alloc=None, lazy=False):
+        # alloc(w, h) gives the RGB888 array a raw frame is decoded into,
+        # with lazy a Frame holding the undecoded payload is returned
+        drained = self._take_drained()
+        if drained is not None:
+            size, buff = drained
+        else:
+            size = self.fb_size
+            buff = self._fb_read(size)
+        if buff is None:
+            return None
+        if lazy:
+            # the frame keeps the buffer, it is not given back to the pool
+            return Frame.from_size(size, buff, self.frame_time)
+        try:
+            return self.decode(size, buff, alloc)
+        finally:
+            self.pool.put(buff)
 
+    def _fb_read(self, size):
         if not size[0]:
             # frame not ready
             return None
@@ -128,36 +513,125 @@ class OpenMV(object):
         else:
             num_bytes = size[0]*size[1]*size[2]
 
-        # read fb data
+        # read fb data into a pooled buffer, give it back with pool.put
+        buff = self.pool.get(num_bytes, exact=size[2] <= 2)
         self._serial.write(struct.pack("<BBI", USBDBG_CMD, USBDBG_FRAME_DUMP, num_bytes))
-        buff = self._serial.read(num_bytes)
-
-        if size[2] == 1:  # Grayscale
-            y = np.fromstring(buff, dtype=np.uint8)
-            buff = np.column_stack((y, y, y))
-        elif size[2] == 2:  # RGB565
-            arr = np.fromstring(buff, dtype=np.uint16).newbyteorder('S')
-            r = (((arr & 0xF800) >> 11)*255.0/31.0).astype(np.uint8)
-            g = (((arr & 0x07E0) >> 5) * 255.0/63.0).astype(np.uint8)
-            b = (((arr & 0x001F) >> 0) * 255.0/31.0).astype(np.uint8)
-            buff = np.column_stack((r, g, b))
-        else:  # JPEG
-            try:
-                buff = np.asarray(Image.frombuffer("RGB", size[0:2], buff, "jpeg", "RGB", ""))
-            except Exception as e:
-                print("JPEG decode error (%s)" % (e))
-                return None
-
-        if (buff.size != (size[0]*size[1]*3)):
+        if self._readinto(buff) != num_bytes:
+            self.pool.put(buff)
+            self._short_read()
             return None
-
-        return (size[0], size[1], buff.reshape((size[1], size[0], 3)))
+        self.rx_bytes += num_bytes
+        self.frame_time = time.time()
+        return buff
+
+    def decode(self, size, buff, alloc=None, draft=1):
+        # draft > 1 gives a frame reduced by that scale, alloc is not used
+        start = time.perf_counter()
+        frame = Frame.from_size(size, buff)
+        try:
+            if draft > 1:
+                out = frame.draft(draft)
+            elif frame.format != FB_JPEG:
+                out = frame.rgb((alloc or self.frame_buffer)(size[0], size[1]))
+            else:
+                out = frame.rgb()
+        except Exception as e:
+            with self._decode_lock:
+                self.decode_errors += 1
+                self.decode_error = '{} decode error ({})'.format(frame.format, str(e) or e.__class__.__name__)
+            return None
+        with self._decode_lock:
+            self.decode_time = time.perf_counter() - start
+
+        return (out.shape[1], out.shape[0], out)
+
+    def _fb_step(self):
+        # one frame of fb_stream: the size query was sent by the previous
+        # step, the next one goes out as soon as the data is read so the
+        # camera answers it while this frame is decoded
+        with self.scheduler.command(CMD_BULK):
+            drained = self._take_drained()
+            if drained is not None:
+                return drained[0], drained[1], 0.0, 0.0
+            start = time.perf_counter()
+            if not self._size_pending:
+                self._fb_size_request()
+            size = self._fb_size_reply()
+            sized = time.perf_counter()
+            buff = self._fb_read(size)
+            self._fb_size_request()
+            return size, buff, sized - start, time.perf_counter() - sized
+
+    def fb_stream(self, slots=3, lazy=False, workers=1, draft=1, stop=None):
+        # frames decoded on worker threads while the next ones are read and
+        # given in capture order, PIL lets go of the GIL while decoding JPEG
+        # so several workers keep up with a fast camera. The array of a
+        # frame is reused slots - 1 frames later, draft > 1 gives reduced
+        # previews. With lazy the undecoded Frame objects are given. The
+        # stream ends when the stop event is set.
+        slots = max(slots, workers + 2)
+        rings = {}
+        rings_lock = threading.Lock()
+
+        def alloc(slot):
+            def buffer(w, h):
+                with rings_lock:
+                    ring = rings.get((w, h))
+                    if ring is None:
+                        ring = rings[(w, h)] = [np.empty((h, w, 3), dtype=np.uint8) for _ in range(slots)]
+                return ring[slot]
+            return buffer
+
+        def decode(size, buff, slot, stamp):
+            if lazy:
+                return Frame.from_size(size, buff, stamp), 0.0
+            start = time.perf_counter()
+            try:
+                return self.decode(size, buff, alloc(slot), draft), time.perf_counter() - start
+            finally:
+                self.pool.put(buff)
+
+        seq = 0
+        count = 0
+        last = time.perf_counter()
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            try:
+                while not (stop and stop.is_set()):
+                    size, buff, wait, transfer = self._fb_step()
+                    if buff is not None:
+                        count += 1
+                        pending.append((pool.submit(decode, size, buff, count % slots, self.frame_time), wait, transfer))
+                    else:
+                        time.sleep(0.001)
+                    # in order: the oldest frame once it is decoded or when
+                    # every worker is busy
+                    while pending and (len(pending) > workers or pending[0][0].done()):
+                        job, wait, transfer = pending.popleft()
+                        frame, took = job.result()
+                        if frame is not None:
+                            now = time.perf_counter()
+                            seq += 1
+                            self.timings.append(FrameTiming(seq, wait, transfer, took, now - last))
+                            last = now
+                            yield frame
+            finally:
+                with self.scheduler.command():
+                    self._drain()
+
+    def frame_buffer(self, w, h):
+        # the RGB888 array of a resolution, overwritten by the next frame
+        if (w, h) not in self._frames:
+            self._frames[(w, h)] = np.empty((h, w, 3), dtype=np.uint8)
+        return self._frames[(w, h)]
 
     @property
+    @lock_func
     def arch_id(self):
         self._serial.write(struct.pack("<BBI", USBDBG_CMD, USBDBG_ARCH_STR, 64))
         return self._serial.read(64).split(b'\x00', 1)[0].decode()
 
+    @lock_func
     def reset(self):
         self._serial.write(struct.pack("<BBI", USBDBG_CMD, USBDBG_SYS_RESET, 0))
 
@@ -0,0 +1,95 @@
+import argparse
+import json
+import time
+import tracemalloc
+
+from .openmv import FB_GRAY, FB_JPEG, FB_RGB565, OpenMV
+from .openmvemu import OpenMVEmulator
+
+
+def capture(cam, mode):
+    # a function taking one frame of the mode
+    if mode == 'stream':
+        stream = cam.fb_stream()
+        return lambda: next(stream), stream.close
+    lazy = mode == 'lazy'
+
+    def dump():
+        frame = None
+        while frame is None:
+            frame = cam.fb_dump(lazy=lazy)
+        return frame
+    return dump, None
+
+
+def bench_capture(cam, mode, frames):
+    take, close = capture(cam, mode)
+    take()
+    decode = 0.0
+    start = time.perf_counter()
+    for _ in range(frames):
+        take()
+        decode += cam.decode_time if mode != 'stream' else cam.timings[-1].decode
+    elapsed = time.perf_counter() - start
+
+    # python allocations of every frame, counted apart from the timing:
+    # the peak of memory allocated while taking a frame, and the blocks
+    # still held after it
+    tracemalloc.start()
+    base = tracemalloc.take_snapshot()
+    peak = 0
+    for _ in range(frames):
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        take()
+        peak += tracemalloc.get_traced_memory()[1] - current
+    snap = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    if close:
+        close()
+    stats = snap.compare_to(base, 'filename')
+    return {
+        'fps': round(frames / elapsed, 1),
+        'decode_ms': round(decode / frames * 1000, 3) if mode != 'lazy' else 0.0,
+        'alloc_bytes_per_frame': round(peak / float(frames)),
+        'blocks_per_frame': round(sum(max(s.count_diff, 0) for s in stats) / float(frames), 2),
+    }
+
+
+def run(size=(320, 240), formats=(FB_GRAY, FB_RGB565, FB_JPEG), modes=('dump', 'lazy', 'stream'),
+        frames=200, bandwidth=None):
+    results = {'size': '{}x{}'.format(*size), 'frames': frames, 'bandwidth': bandwidth, 'runs': []}
+    for fmt in formats:
+        for mode in modes:
+            with OpenMVEmulator(size[0], size[1], fmt, fps=0, bandwidth=bandwidth, running=True) as emu:
+                cam = OpenMV(port=emu.port)
+                cam.connect()
+                run = {'format': fmt, 'mode': mode}
+                run.update(bench_capture(cam, mode, frames))
+                run['short_reads'] = cam.short_reads
+                run['decode_errors'] = cam.decode_errors
+                cam.disconnect()
+            results['runs'].append(run)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--size', default='320x240', help='frame size, WxH')
+    parser.add_argument('-n', '--frames', type=int, default=200, help='frames of every run')
+    parser.add_argument('-b', '--bandwidth', type=int, help='emulated usb link bytes per second')
+    parser.add_argument('-f', '--format', action='append', choices=(FB_GRAY, FB_RGB565, FB_JPEG), help='frame formats, all when not given')
+    parser.add_argument('-j', '--json', type=argparse.FileType(mode='w'), help='write the results as json')
+    args = parser.parse_args()
+
+    size = tuple(int(x) for x in args.size.lower().split('x'))
+    results = run(size, args.format or (FB_GRAY, FB_RGB565, FB_JPEG), frames=args.frames, bandwidth=args.bandwidth)
+    for r in results['runs']:
+        print('{format:<7} {mode:<7} {fps:8.1f} fps  decode {decode_ms:7.3f} ms  '
+              'allocated {alloc_bytes_per_frame:7d} bytes {blocks_per_frame:5.2f} blocks/frame'.format(**r))
+    if args.json:
+        json.dump(results, args.json, indent=1)
+
+
+if __name__ == '__main__':
+    main()
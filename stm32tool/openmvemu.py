@@ -0,0 +1,259 @@
+import argparse
+import io
+import os
+import pty
+import select
+import struct
+import threading
+import time
+import tty
+
+import numpy as np
+from PIL import Image
+
+from .openmv import (BOOTLDR_ERASE, BOOTLDR_FLASH, BOOTLDR_RESET, BOOTLDR_START, BOOTLDR_WRITE,
+                     FB_GRAY, FB_JPEG, FB_RGB565, USBDBG_ARCH_STR, USBDBG_CMD, USBDBG_FB_ENABLE,
+                     USBDBG_FRAME_DUMP, USBDBG_FRAME_SIZE, USBDBG_FW_VERSION, USBDBG_SCRIPT_EXEC,
+                     USBDBG_SCRIPT_STOP, USBDBG_SYS_RESET, USBDBG_TX_BUF, USBDBG_TX_BUF_LEN)
+
+USBDBG_HEADER = struct.Struct('<BBI')
+TX_BUF_SIZE = 0x200
+# flash_write of stm32tool.entry.flash sends 60 bytes at most
+BOOTLDR_WRITE_MAX = 60
+BOOTLDR_SECTORS = (1, 15)
+
+
+class Stopped(Exception):
+    pass
+
+
+def synthetic_frames(width, height, format, count=8, quality=90):
+    # count frames of a moving color pattern, as the camera sends them
+    x = np.arange(width, dtype=np.uint32)[np.newaxis, :]
+    y = np.arange(height, dtype=np.uint32)[:, np.newaxis]
+    frames = []
+    for i in range(count):
+        shift = i * width // count
+        r = ((x + shift) * 255 // max(1, width - 1)) & 0xFF
+        g = (y * 255 // max(1, height - 1)) & 0xFF
+        b = ((x ^ y) + i * 16) & 0xFF
+        r, g, b = np.broadcast_arrays(r, g, b)
+        if format == FB_GRAY:
+            gray = (r * 77 + g * 150 + b * 29) >> 8
+            frames.append(gray.astype(np.uint8).tobytes())
+        elif format == FB_RGB565:
+            pixel = ((r >> 3) << 11) | ((g >> 2) << 5) | (b >> 3)
+            frames.append(pixel.astype('>u2').tobytes())
+        else:
+            out = io.BytesIO()
+            Image.fromarray(np.dstack((r, g, b)).astype(np.uint8)).save(out, 'JPEG', quality=quality)
+            frames.append(out.getvalue())
+    return frames
+
+
+class OpenMVEmulator(object):
+    # the usb debug protocol of an OpenMV camera on a pseudo terminal, open
+    # self.port with OpenMV(port=...). While a script runs a new synthetic
+    # frame is ready every 1 / fps seconds (fps 0: always), and the script
+    # prints its fps like hello_world. bandwidth is the bytes per second of
+    # the emulated usb link, unlimited when not given.
+    def __init__(self, width=320, height=240, format=FB_RGB565, fps=30, bandwidth=None,
+                 running=False, version=(4, 1, 2), arch='OMV4 H7 1024 SDRAM', quality=90):
+        if format not in (FB_GRAY, FB_RGB565, FB_JPEG):
+            raise ValueError('unknown frame format: {}'.format(format))
+        self.width = width
+        self.height = height
+        self.format = format
+        self.fps = fps
+        self.bandwidth = bandwidth
+        self.running = running
+        self.fb_enabled = True
+        self.version = version
+        self.arch = arch
+        self.script = None
+        self.frames = synthetic_frames(width, height, format, quality=quality)
+        self.served = 0
+        self.tx = bytearray()
+        self.flash = {}
+        self.erased = []
+        self.resets = 0
+        self.stats = {}
+        self._ready = None
+        self._sent = True
+        # the frame buffer lock, held from a non zero frame size until the
+        # frame is dumped; a size query meanwhile gets 0
+        self._held = False
+        self._frame_time = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._master)
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def _read(self, num, timeout=None):
+        # num bytes, fewer when nothing came for timeout seconds
+        data = b''
+        idle = time.time()
+        while len(data) < num:
+            ready, _, _ = select.select([self._master], [], [], 0.01 if timeout else 0.1)
+            if self._stop.is_set():
+                raise Stopped()
+            if ready:
+                data += os.read(self._master, num - len(data))
+                idle = time.time()
+            elif timeout and time.time() - idle > timeout:
+                break
+        return data
+
+    def _send(self, data):
+        if self.bandwidth:
+            time.sleep(len(data) / float(self.bandwidth))
+        view = memoryview(data)
+        while view:
+            # the pty buffer is small, wait for the host to read
+            _, ready, _ = select.select([], [self._master], [], 0.1)
+            if self._stop.is_set():
+                raise Stopped()
+            if ready:
+                view = view[os.write(self._master, view):]
+
+    def _frame(self):
+        # the frame to be dumped next, None when no new frame is ready
+        if not self.running or not self.fb_enabled:
+            return None
+        now = time.time()
+        if self._sent and (not self.fps or now - self._frame_time >= 1.0 / self.fps):
+            self._ready = self.frames[self.served % len(self.frames)]
+            self._sent = False
+            fps = 1.0 / (now - self._frame_time) if self._frame_time else 0.0
+            self._frame_time = now
+            self.output('{:.5f}\n'.format(fps))
+        return None if self._sent else self._ready
+
+    def output(self, text):
+        # script output, the oldest is lost when the buffer is full
+        self.tx += text.encode()
+        del self.tx[:-TX_BUF_SIZE]
+
+    def _serve(self):
+        try:
+            while not self._stop.is_set():
+                head = self._read(1)
+                if head[0] == USBDBG_CMD:
+                    _, cmd, length = USBDBG_HEADER.unpack(head + self._read(USBDBG_HEADER.size - 1))
+                    self.stats[cmd] = self.stats.get(cmd, 0) + 1
+                    self._usbdbg(cmd, length)
+                else:
+                    magic = struct.unpack('<I', head + self._read(3))[0]
+                    self._bootloader(magic)
+        except (Stopped, OSError):
+            pass
+
+    def _usbdbg(self, cmd, length):
+        if cmd == USBDBG_FW_VERSION:
+            self._send(struct.pack('<3I', *self.version))
+        elif cmd == USBDBG_ARCH_STR:
+            self._send(self.arch.encode()[:length - 1].ljust(length, b'\x00'))
+        elif cmd == USBDBG_FRAME_SIZE:
+            frame = None if self._held else self._frame()
+            if frame is None:
+                self._send(struct.pack('<3I', 0, 0, 0))
+            elif self.format == FB_JPEG:
+                self._send(struct.pack('<3I', self.width, self.height, len(frame)))
+            else:
+                bpp = 1 if self.format == FB_GRAY else 2
+                self._send(struct.pack('<3I', self.width, self.height, bpp))
+            if frame is not None:
+                self._held = True
+        elif cmd == USBDBG_FRAME_DUMP:
+            self._held = False
+            frame = self._ready if self._ready is not None else b''
+            self._send(frame[:length].ljust(length, b'\x00'))
+            if not self._sent:
+                self._sent = True
+                self.served += 1
+        elif cmd == USBDBG_SCRIPT_EXEC:
+            self.script = self._read(length).decode('utf-8', 'replace')
+            self.running = True
+        elif cmd == USBDBG_SCRIPT_STOP:
+            self.running = False
+        elif cmd == USBDBG_FB_ENABLE:
+            self.fb_enabled = bool(struct.unpack('<H', self._read(2))[0])
+        elif cmd == USBDBG_SYS_RESET:
+            self.resets += 1
+            self.running = False
+            self._held = False
+            self.tx = bytearray()
+        elif cmd == USBDBG_TX_BUF_LEN:
+            self._send(struct.pack('<I', len(self.tx)))
+        elif cmd == USBDBG_TX_BUF:
+            data = bytes(self.tx[:length])
+            del self.tx[:length]
+            self._send(data.ljust(length, b'\x00'))
+        elif length and cmd & 0x80:
+            # other reads get zeros
+            self._send(bytes(length))
+        elif length:
+            self._read(length, timeout=0.05)
+
+    def _bootloader(self, magic):
+        if magic == BOOTLDR_START:
+            self._send(struct.pack('<I', BOOTLDR_RESET))
+        elif magic == BOOTLDR_FLASH:
+            self._send(struct.pack('<3I', 0, *BOOTLDR_SECTORS))
+        elif magic == BOOTLDR_ERASE:
+            self.erased.append(struct.unpack('<I', self._read(4))[0])
+        elif magic == BOOTLDR_WRITE:
+            # the length is not sent, a write is the bytes of one usb packet:
+            # up to 60 bytes or what came before the host paused
+            offset = sum(len(data) for data in self.flash.values())
+            self.flash[offset] = self._read(BOOTLDR_WRITE_MAX, timeout=0.01)
+        elif magic == BOOTLDR_RESET:
+            self.resets += 1
+
+    @property
+    def image(self):
+        # the bytes written through the bootloader
+        return b''.join(self.flash[offset] for offset in sorted(self.flash))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--size', default='320x240', help='frame size, WxH')
+    parser.add_argument('-f', '--format', default=FB_RGB565, choices=(FB_GRAY, FB_RGB565, FB_JPEG), help='frame format')
+    parser.add_argument('-r', '--fps', type=float, default=30, help='frames per second, 0 for as fast as read')
+    parser.add_argument('-b', '--bandwidth', type=int, help='usb link bytes per second')
+    parser.add_argument('-a', '--always', action='store_true', default=False, help='send frames without a running script')
+    args = parser.parse_args()
+    width, height = (int(x) for x in args.size.lower().split('x'))
+    emu = OpenMVEmulator(width, height, args.format, args.fps, args.bandwidth, running=args.always)
+    print('openmv emulator on: {}'.format(emu.port))
+    emu.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        emu.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+import argparse
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .entry.data import hello_world
+from .openmv import OpenMV, get_openmv_ports
+
+
+class CameraStats(object):
+    def __init__(self):
+        self.frames = 0
+        self.start = time.time()
+        self.times = deque(maxlen=30)
+
+    def add(self):
+        self.frames += 1
+        self.times.append(time.time())
+
+    @property
+    def fps(self):
+        if len(self.times) < 2:
+            return 0.0
+        return (len(self.times) - 1) / (self.times[-1] - self.times[0])
+
+
+class OpenMVPool(object):
+    # every attached camera by usb serial number, each one captured on its
+    # own thread with its own fb_stream so the cameras run in parallel.
+    # callback(serial, frame) is called on the capture thread of the
+    # camera, latest(serial) gives the newest frame of a camera.
+    def __init__(self, serials=None, lazy=False, workers=1, callback=None):
+        self.serials = serials
+        self.lazy = lazy
+        self.workers = workers
+        self.callback = callback
+        self.cams = {}
+        self.stats = {}
+        self.errors = {}
+        self._latest = {}
+        self._stop = threading.Event()
+        self._threads = []
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def enumerate():
+        # {serial number: device}, the device name stands in for a camera
+        # without a serial number
+        return dict((port.serial_number or port.device, port.device) for port in get_openmv_ports())
+
+    def open(self):
+        ports = self.enumerate()
+        if self.serials is not None:
+            ports = dict((serial, dev) for serial, dev in ports.items() if serial in self.serials)
+
+        def connect(item):
+            serial, dev = item
+            cam = OpenMV(port=dev)
+            return serial, cam if cam.connect() else None
+
+        with ThreadPoolExecutor(max_workers=max(1, len(ports))) as pool:
+            for serial, cam in pool.map(connect, ports.items()):
+                if cam is not None:
+                    self.cams[serial] = cam
+        return list(self.cams)
+
+    def run_script(self, script):
+        def run(cam):
+            cam.stop_script()
+            cam.fb_enable(True)
+            cam.exec_script(script)
+        with ThreadPoolExecutor(max_workers=max(1, len(self.cams))) as pool:
+            list(pool.map(run, self.cams.values()))
+
+    def start(self):
+        self._stop.clear()
+        for serial, cam in self.cams.items():
+            self.stats[serial] = CameraStats()
+            thread = threading.Thread(target=self._capture, args=(serial, cam), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _capture(self, serial, cam):
+        stats = self.stats[serial]
+        try:
+            for frame in cam.fb_stream(lazy=self.lazy, workers=self.workers, stop=self._stop):
+                stats.add()
+                self._latest[serial] = frame
+                if self.callback:
+                    self.callback(serial, frame)
+        except Exception as e:
+            # a camera going away does not stop the others
+            self.errors[serial] = str(e) or e.__class__.__name__
+
+    def stop(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def close(self):
+        self.stop()
+        for cam in self.cams.values():
+            cam.disconnect()
+        self.cams = {}
+
+    def latest(self, serial):
+        # the newest frame of a camera. fb_stream overwrites the array of a
+        # decoded frame a few frames later, so it is given as a copy; a lazy
+        # Frame keeps its own payload.
+        frame = self._latest.get(serial)
+        if frame is None or self.lazy:
+            return frame
+        w, h, image = frame
+        return w, h, image.copy()
+
+    def report(self):
+        # fps of the last frames and average received bytes per second,
+        # of every camera and all of them
+        cams = {}
+        for serial, stats in self.stats.items():
+            elapsed = time.time() - stats.start
+            cams[serial] = {
+                'frames': stats.frames,
+                'fps': round(stats.fps, 2),
+                'Bps': round(self.cams[serial].rx_bytes / elapsed) if elapsed else 0,
+            }
+            if serial in self.errors:
+                cams[serial]['error'] = self.errors[serial]
+        return {
+            'cameras': cams,
+            'frames': sum(c['frames'] for c in cams.values()),
+            'fps': round(sum(c['fps'] for c in cams.values()), 2),
+            'Bps': sum(c['Bps'] for c in cams.values()),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('serials', nargs='*', help='usb serial numbers of the cameras, all attached cameras when empty')
+    parser.add_argument('-f', '--file', help='script file run on every camera')
+    parser.add_argument('-t', '--time', type=float, help='seconds of capture, until ctrl-c when not given')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='decode threads of every camera')
+    parser.add_argument('-r', '--raw', action='store_true', default=False, help='do not decode the frames')
+    args = parser.parse_args()
+
+    pool = OpenMVPool(args.serials or None, lazy=args.raw, workers=args.workers)
+    if not pool.open():
+        print('Please connect your OpenMV cameras')
+        exit()
+    pool.run_script(open(args.file, 'r').read() if args.file else hello_world)
+    pool.start()
+    start = time.time()
+    try:
+        while args.time is None or time.time() - start < args.time:
+            time.sleep(1)
+            report = pool.report()
+            cams = ' '.join('{}:{:.1f}'.format(serial, c['fps']) for serial, c in report['cameras'].items())
+            print('{} cameras, {:.1f} fps, {:.1f} KB/s  {}'.format(
+                len(report['cameras']), report['fps'], report['Bps'] / 1024, cams))
+    except KeyboardInterrupt:
+        pass
+    for cam in pool.cams.values():
+        cam.stop_script()
+    pool.close()
+
+
+if __name__ == '__main__':
+    main()
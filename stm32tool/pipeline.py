@@ -0,0 +1,270 @@
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+END = object()
+
+
+def rgb(frame):
+    # decode stage: (h, w, 3) RGB888 array of a lazy Frame
+    return frame.rgb()
+
+
+def gray(frame):
+    # decode stage: (h, w) luma array of a lazy Frame
+    return frame.gray()
+
+
+def latency(times):
+    times = sorted(times)
+    if not times:
+        return {'mean_ms': 0.0, 'p50_ms': 0.0, 'max_ms': 0.0}
+    return {
+        'mean_ms': round(sum(times) / len(times) * 1000, 3),
+        'p50_ms': round(times[len(times) // 2] * 1000, 3),
+        'max_ms': round(times[-1] * 1000, 3),
+    }
+
+
+def _timed(func, value):
+    # runs in the worker, a process pool needs a module level function
+    start = time.perf_counter()
+    result = func(value)
+    return result, time.perf_counter() - start
+
+
+class Stage(object):
+    # func(value) on a pool of workers, threads or processes. A stage which
+    # returns None drops the frame. With ordered the results leave the
+    # stage in the order the frames came in, otherwise as they are done.
+    # For a process stage func and its values must be picklable, lazy
+    # Frame objects are.
+    def __init__(self, func, name=None, workers=1, process=False, ordered=True):
+        self.func = func
+        self.name = name or getattr(func, '__name__', 'stage')
+        self.workers = workers
+        self.process = process
+        self.ordered = ordered
+        self.count = 0
+        self.errors = 0
+        self.error = None
+        self.times = deque(maxlen=1000)
+
+    def executor(self):
+        pool = ProcessPoolExecutor if self.process else ThreadPoolExecutor
+        return pool(max_workers=self.workers)
+
+    def metrics(self):
+        result = {'count': self.count, 'errors': self.errors}
+        result.update(latency(self.times))
+        return result
+
+
+class Pipeline(object):
+    # frames of a camera through stages, each stage has its own thread
+    # feeding its worker pool, and the stages are joined by queues of
+    # queue_size items. A full queue holds up the stage before it, down to
+    # the capture: with drop the capture drops the frame instead of waiting
+    # so the camera keeps its fps. The source is an OpenMV (or Replay), its
+    # frames come as lazy Frame objects, or any iterable of values.
+    #   pipe = Pipeline(cam).add(rgb, workers=2).add(detect, workers=4, process=True)
+    #   for value in pipe.start():
+    def __init__(self, source, queue_size=8, drop=False, ordered=True, lazy=True):
+        self.source = source
+        self.queue_size = queue_size
+        self.drop = drop
+        self.ordered = ordered
+        self.lazy = lazy
+        self.stages = []
+        self.frames = 0
+        self.dropped = 0
+        self.outputs = 0
+        self.latency = deque(maxlen=1000)
+        self._queues = []
+        self._threads = []
+        self._stop = threading.Event()
+        self._times = deque(maxlen=30)
+        self._done = False
+
+    def add(self, func, name=None, workers=1, process=False, ordered=None):
+        ordered = self.ordered if ordered is None else ordered
+        self.stages.append(Stage(func, name, workers, process, ordered))
+        return self
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        self._stop.clear()
+        self._done = False
+        self._queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        self._threads = [threading.Thread(target=self._capture, daemon=True)]
+        for idx, stage in enumerate(self.stages):
+            self._threads.append(threading.Thread(target=self._run, daemon=True,
+                                                  args=(stage, self._queues[idx], self._queues[idx + 1])))
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def _frames(self):
+        if hasattr(self.source, 'fb_stream'):
+            frames = self.source.fb_stream(lazy=self.lazy, stop=self._stop)
+            if self.lazy:
+                return frames
+            # fb_stream reuses its arrays a few frames later, more frames
+            # than that wait in the queues
+            return ((w, h, image.copy()) for w, h, image in frames)
+        return iter(self.source)
+
+    def _put(self, out, item):
+        # wait for room, unless the pipeline is stopped. Once stopped the
+        # oldest item makes room for END, which always gets through so the
+        # next stage ends too.
+        while True:
+            try:
+                out.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                if not self._stop.is_set():
+                    continue
+                if item is not END:
+                    return False
+                try:
+                    out.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def _capture(self):
+        out = self._queues[0]
+        seq = 0
+        for value in self._frames():
+            if self._stop.is_set():
+                break
+            seq += 1
+            self.frames += 1
+            self._times.append(time.time())
+            item = (seq, time.perf_counter(), value)
+            if self.drop:
+                try:
+                    out.put_nowait(item)
+                except queue.Full:
+                    self.dropped += 1
+            elif not self._put(out, item):
+                break
+        self._put(out, END)
+
+    def _run(self, stage, inq, out):
+        pending = deque()
+
+        def emit(job):
+            seq, stamp, future = job
+            try:
+                result, took = future.result()
+            except Exception as e:
+                stage.errors += 1
+                stage.error = str(e) or e.__class__.__name__
+                return
+            stage.count += 1
+            stage.times.append(took)
+            if result is not None:
+                self._put(out, (seq, stamp, result))
+
+        with stage.executor() as pool:
+            while True:
+                if self._stop.is_set():
+                    # the jobs not started yet are dropped, the running ones
+                    # are handed on as far as there is room
+                    for job in pending:
+                        if not job[2].cancel():
+                            emit(job)
+                    break
+                # hand on what is done, oldest first when ordered
+                if stage.ordered:
+                    while pending and pending[0][2].done():
+                        emit(pending.popleft())
+                else:
+                    for job in [job for job in pending if job[2].done()]:
+                        pending.remove(job)
+                        emit(job)
+                # two jobs for every worker at most, so the input queue
+                # fills up and holds up the stage before
+                if len(pending) >= stage.workers * 2:
+                    if stage.ordered:
+                        wait([pending[0][2]])
+                    else:
+                        wait([job[2] for job in pending], return_when=FIRST_COMPLETED)
+                    continue
+                try:
+                    item = inq.get(timeout=0.001 if pending else 0.1)
+                except queue.Empty:
+                    continue
+                if item is END:
+                    while pending:
+                        emit(pending.popleft())
+                    break
+                seq, stamp, value = item
+                pending.append((seq, stamp, pool.submit(_timed, stage.func, value)))
+        self._put(out, END)
+
+    def get(self, timeout=None):
+        # (seq, value) of the next result, None at the end or on timeout
+        if self._done or not self._queues:
+            return None
+        try:
+            item = self._queues[-1].get(timeout=timeout)
+        except queue.Empty:
+            return None
+        if item is END:
+            self._done = True
+            return None
+        seq, stamp, value = item
+        self.outputs += 1
+        self.latency.append(time.perf_counter() - stamp)
+        return seq, value
+
+    def results(self, timeout=None):
+        while True:
+            item = self.get(timeout)
+            if item is None:
+                return
+            yield item[1]
+
+    def __iter__(self):
+        return self.results()
+
+    def stop(self):
+        self._stop.set()
+        # the results nobody takes any more
+        while self._queues and not self._done:
+            self.get(0.1)
+            if not any(thread.is_alive() for thread in self._threads):
+                break
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    @property
+    def fps(self):
+        if len(self._times) < 2:
+            return 0.0
+        return (len(self._times) - 1) / (self._times[-1] - self._times[0])
+
+    def metrics(self):
+        # capture and output counts, capture to output latency and the
+        # time every stage spends on a frame
+        result = {
+            'frames': self.frames,
+            'dropped': self.dropped,
+            'outputs': self.outputs,
+            'fps': round(self.fps, 2),
+            'latency': latency(self.latency),
+            'stages': dict((stage.name, stage.metrics()) for stage in self.stages),
+            'queues': [q.qsize() for q in self._queues],
+        }
+        return result
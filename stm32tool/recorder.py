@@ -0,0 +1,280 @@
+import argparse
+import json
+import os
+import queue
+import struct
+import threading
+import time
+
+from .entry.data import hello_world
+from .openmv import FB_GRAY, FB_JPEG, FB_RGB565, OpenMV
+
+# recording file:
+#   header:  'OMVREC', version, meta length ('<6sHI') + json meta
+#   records: timestamp, width, height, format, length ('<dIIBI') + payload
+#   index:   file offset of every record ('<Q'), then the trailer:
+#            index offset, records, 'OMVIDX' ('<QI6s')
+# A recording that was not closed has no index, the records are scanned.
+REC_MAGIC = b'OMVREC'
+REC_VERSION = 1
+IDX_MAGIC = b'OMVIDX'
+REC_HEADER = struct.Struct('<6sHI')
+REC_FRAME = struct.Struct('<dIIBI')
+REC_TRAILER = struct.Struct('<QI6s')
+
+FORMATS = {FB_GRAY: 1, FB_RGB565: 2, FB_JPEG: 3}
+FORMAT_NAMES = dict((code, name) for name, code in FORMATS.items())
+
+
+class Recorder(object):
+    # appends frames as sent by the camera to a recording without decoding
+    # them, a thread does the writing. add() never blocks the capture: when
+    # queue frames are waiting the new one is dropped and counted.
+    def __init__(self, path, meta=None, queue_size=64):
+        self.path = path
+        self.frames = 0
+        self.nbytes = 0
+        self.dropped = 0
+        self._error = None
+        self._index = []
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._file = open(path, 'wb')
+        meta = json.dumps(meta or {}).encode()
+        self._file.write(REC_HEADER.pack(REC_MAGIC, REC_VERSION, len(meta)) + meta)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add(self, frame):
+        # frame is a lazy Frame of fb_dump(lazy=True) or fb_stream(lazy=True)
+        try:
+            self._queue.put_nowait(frame)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        try:
+            while True:
+                frame = self._queue.get()
+                if frame is None:
+                    break
+                self._index.append(self._file.tell())
+                self._file.write(REC_FRAME.pack(frame.timestamp, frame.width, frame.height,
+                                                FORMATS[frame.format], frame.nbytes))
+                self._file.write(frame.data)
+                self.frames += 1
+                self.nbytes += frame.nbytes
+        except Exception as e:
+            # raised again by close
+            self._error = e
+
+    def close(self):
+        if self._file is None:
+            return
+        # a writer which died takes nothing from the queue any more
+        while self._thread.is_alive():
+            try:
+                self._queue.put(None, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        self._thread.join()
+        if self._error is not None:
+            # no index, the records written are found by a scan
+            self._file.close()
+            self._file = None
+            raise self._error
+        offset = self._file.tell()
+        self._file.write(struct.pack('<{}Q'.format(len(self._index)), *self._index))
+        self._file.write(REC_TRAILER.pack(offset, len(self._index), IDX_MAGIC))
+        self._file.close()
+        self._file = None
+
+
+def read_index(fileobj):
+    # (meta, record offsets) of a recording
+    fileobj.seek(0)
+    magic, version, length = REC_HEADER.unpack(fileobj.read(REC_HEADER.size))
+    if magic != REC_MAGIC:
+        raise Exception('not a recording: {}'.format(getattr(fileobj, 'name', '')))
+    if version != REC_VERSION:
+        raise Exception('unknown recording version: {}'.format(version))
+    meta = json.loads(fileobj.read(length).decode() or '{}')
+    start = fileobj.tell()
+    end = fileobj.seek(0, os.SEEK_END)
+    if end - start >= REC_TRAILER.size:
+        fileobj.seek(end - REC_TRAILER.size)
+        offset, count, magic = REC_TRAILER.unpack(fileobj.read(REC_TRAILER.size))
+        if magic == IDX_MAGIC and offset + count * 8 + REC_TRAILER.size == end:
+            fileobj.seek(offset)
+            return meta, list(struct.unpack('<{}Q'.format(count), fileobj.read(count * 8)))
+    # not closed, every complete record
+    index = []
+    offset = start
+    while offset + REC_FRAME.size <= end:
+        fileobj.seek(offset)
+        length = REC_FRAME.unpack(fileobj.read(REC_FRAME.size))[4]
+        if offset + REC_FRAME.size + length > end:
+            break
+        index.append(offset)
+        offset += REC_FRAME.size + length
+    return meta, index
+
+
+class Replay(OpenMV):
+    # a recording in place of a camera: fb_dump, fb_stream and the rest of
+    # OpenMV work the same and give the recorded frames. By default frames
+    # come as fast as they are read, realtime keeps the recorded pace and
+    # loop starts over at the end. Control commands do nothing.
+    def __init__(self, path, realtime=False, loop=False):
+        super(Replay, self).__init__(port=path)
+        self.realtime = realtime
+        self.loop = loop
+        self.meta = {}
+        self.index = []
+        self.pos = 0
+        self._file = None
+        self._record = None
+        self._clock = None
+
+    def __del__(self):
+        if self._file:
+            self._file.close()
+
+    def connect(self):
+        if not self._connect:
+            try:
+                self._file = open(self._port, 'rb')
+                self.meta, self.index = read_index(self._file)
+                self._connect = True
+            except Exception as e:
+                print(e)
+        return self._connect
+
+    def disconnect(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+        self._connect = False
+
+    @property
+    def eof(self):
+        return self.pos >= len(self.index) and not self.loop
+
+    def seek(self, pos):
+        with self.scheduler.command():
+            self.pos = pos
+            self._record = None
+            self._clock = None
+
+    def _read_record(self):
+        if self.pos >= len(self.index):
+            if not self.loop or not self.index:
+                return None
+            self.pos = 0
+            self._clock = None
+        self._file.seek(self.index[self.pos])
+        return REC_FRAME.unpack(self._file.read(REC_FRAME.size))
+
+    def _fb_size_request(self):
+        self._size_pending = True
+
+    def _fb_size_reply(self):
+        # the size of the next record, it is taken by _fb_read
+        self._size_pending = False
+        if self._record is None:
+            self._record = self._read_record()
+        if self._record is None:
+            return (0, 0, 0)
+        stamp, width, height, fmt, length = self._record
+        if self.realtime:
+            if self._clock is None:
+                self._clock = time.time() - stamp
+            delay = stamp + self._clock - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        if FORMAT_NAMES[fmt] == FB_JPEG:
+            return (width, height, length)
+        return (width, height, length // (width * height))
+
+    def _fb_read(self, size):
+        if not size[0] or self._record is None:
+            return None
+        length = self._record[4]
+        buff = self.pool.get(length, exact=size[2] <= 2)
+        if self._file.readinto(buff) != length:
+            self.pool.put(buff)
+            self._record = None
+            self.pos = len(self.index)
+            return None
+        self.frame_time = self._record[0]
+        self.rx_bytes += length
+        self._record = None
+        self.pos += 1
+        return buff
+
+    @property
+    def fw_version(self):
+        return self.meta.get('fw_version', '')
+
+    @property
+    def arch_id(self):
+        return self.meta.get('arch', 'replay')
+
+    def exec_script(self, buf):
+        pass
+
+    def stop_script(self):
+        pass
+
+    def fb_enable(self, enable):
+        pass
+
+    def reset(self):
+        self.seek(0)
+
+    def tx_buf_len(self):
+        return 0
+
+    def tx_buf(self, bytes):
+        return b''
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('output', help='recording file')
+    parser.add_argument('-f', '--file', help='script file')
+    parser.add_argument('-t', '--time', type=float, help='seconds of recording, until ctrl-c when not given')
+    args = parser.parse_args()
+
+    cam = OpenMV()
+    if not cam.connect():
+        exit()
+    cam.stop_script()
+    cam.fb_enable(True)
+    cam.exec_script(open(args.file, 'r').read() if args.file else hello_world)
+
+    recorder = Recorder(args.output, {'fw_version': cam.fw_version, 'arch': cam.arch_id})
+    stop = threading.Event()
+    if args.time:
+        threading.Timer(args.time, stop.set).start()
+    start = time.time()
+    try:
+        for frame in cam.fb_stream(lazy=True, stop=stop):
+            recorder.add(frame)
+    except KeyboardInterrupt:
+        pass
+    recorder.close()
+    cam.stop_script()
+    cam.disconnect()
+    print('{} frames, {:.1f} MB in {:.1f}s, {} dropped'.format(
+        recorder.frames, recorder.nbytes / 1048576.0, time.time() - start, recorder.dropped))
+
+
+if __name__ == '__main__':
+    main()
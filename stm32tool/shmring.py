@@ -0,0 +1,266 @@
+import argparse
+import struct
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from .entry.data import hello_world
+from .openmv import OpenMV
+
+# shared memory layout:
+#   header: magic, version, slots, slot bytes, head ('<8sIIIxxxxQ'), head is the
+#           sequence number of the newest frame, 0 before the first one
+#   slots:  begin, end, width, height, channels, timestamp ('<QQIIId') and
+#           the pixels, frame seq is in slot seq % slots
+# The publisher sets begin before writing a slot and end after it, a reader
+# whose frame has begin == end == seq before and after using it had a
+# frame which was not overwritten meanwhile.
+SHM_MAGIC = b'OMVSHM\x00\x00'
+SHM_VERSION = 1
+SHM_HEADER = struct.Struct('<8sIIIxxxxQ')
+SLOT_HEADER = struct.Struct('<QQIIId')
+HEAD_OFFSET = 24
+ALIGN = 64
+SHM_NAME = 'openmv'
+
+
+def _align(num):
+    return -(-num // ALIGN) * ALIGN
+
+
+_attach_lock = threading.Lock()
+
+
+def attach(name):
+    # only the publisher may unlink the memory. Before python 3.13 attaching
+    # registers it with the resource tracker too, which would remove it when
+    # the subscriber ends.
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        pass
+    with _attach_lock:
+        register = resource_tracker.register
+        resource_tracker.register = lambda *args: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+class SharedRing(object):
+    def __init__(self, shm):
+        self.shm = shm
+        magic, version, self.slots, self.slot_size, _ = SHM_HEADER.unpack_from(shm.buf, 0)
+        if magic != SHM_MAGIC:
+            raise Exception('not a frame ring: {}'.format(shm.name))
+        if version != SHM_VERSION:
+            raise Exception('unknown frame ring version: {}'.format(version))
+        self.stride = _align(SLOT_HEADER.size) + _align(self.slot_size)
+        self._head = np.ndarray((1,), dtype=np.uint64, buffer=shm.buf, offset=HEAD_OFFSET)
+        self._data = []
+        for slot in range(self.slots):
+            base = _align(SHM_HEADER.size) + slot * self.stride
+            self._data.append(np.ndarray((self.slot_size,), dtype=np.uint8, buffer=shm.buf,
+                                         offset=base + _align(SLOT_HEADER.size)))
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def head(self):
+        return int(self._head[0])
+
+    def _slot_offset(self, seq):
+        return _align(SHM_HEADER.size) + (seq % self.slots) * self.stride
+
+    def header(self, seq):
+        # (begin, end, width, height, channels, timestamp) of the slot of seq
+        return SLOT_HEADER.unpack_from(self.shm.buf, self._slot_offset(seq))
+
+    def view(self, seq, width, height, channels):
+        data = self._data[seq % self.slots][:width * height * channels]
+        shape = (height, width, channels) if channels > 1 else (height, width)
+        return data.reshape(shape)
+
+    def valid(self, seq):
+        # the frame of seq is complete and was not overwritten since
+        begin, end = self.header(seq)[:2]
+        return begin == end == seq
+
+    def close(self):
+        self._head = None
+        self._data = []
+        self.shm.close()
+
+
+class FramePublisher(SharedRing):
+    # decoded frames of a camera in a shared memory ring, other processes
+    # map them as numpy arrays with FrameSubscriber and never copy them.
+    # The frame decoded by fb_dump goes straight into its slot; a slot is
+    # written again slots frames later.
+    def __init__(self, width, height, channels=3, slots=4, name=SHM_NAME):
+        slot_size = width * height * channels
+        stride = _align(SLOT_HEADER.size) + _align(slot_size)
+        shm = shared_memory.SharedMemory(name=name, create=True, size=_align(SHM_HEADER.size) + slots * stride)
+        SHM_HEADER.pack_into(shm.buf, 0, SHM_MAGIC, SHM_VERSION, slots, slot_size, 0)
+        super(FramePublisher, self).__init__(shm)
+        self.channels = channels
+        self.skipped = 0
+        self._next = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def alloc(self, width, height):
+        # the slot of the next frame, the alloc of OpenMV.fb_dump
+        seq = self.head + 1
+        if width * height * self.channels > self.slot_size:
+            # larger than the frames the ring was made for
+            self._next = None
+            return np.empty((height, width, self.channels), dtype=np.uint8)
+        offset = self._slot_offset(seq)
+        struct.pack_into('<Q', self.shm.buf, offset, seq)
+        self._next = (seq, width, height)
+        return self.view(seq, width, height, self.channels)
+
+    def commit(self, out, timestamp=None):
+        # publish the frame given by the last alloc, out is its image
+        if self._next is None:
+            self.skipped += 1
+            return None
+        seq, width, height = self._next
+        self._next = None
+        view = self.view(seq, width, height, self.channels)
+        if out is not view:
+            np.copyto(view, out.reshape(view.shape))
+        struct.pack_into('<QIIId', self.shm.buf, self._slot_offset(seq) + 8, seq, width, height,
+                         self.channels, time.time() if timestamp is None else timestamp)
+        self._head[0] = seq
+        return seq
+
+    def publish(self, frame):
+        # a (w, h, image) of fb_dump or a lazy Frame, decoded into its slot
+        if isinstance(frame, tuple):
+            self.alloc(frame[0], frame[1])
+            return self.commit(frame[2])
+        out = self.alloc(frame.width, frame.height)
+        if self.channels == 1:
+            return self.commit(frame.gray(), frame.timestamp)
+        return self.commit(frame.rgb(out), frame.timestamp)
+
+    def capture(self, cam, stop=None):
+        # publish the frames of cam until stop is set
+        while not (stop and stop.is_set()):
+            if self.channels == 1:
+                frame = cam.fb_dump(lazy=True)
+                if frame is not None:
+                    self.publish(frame)
+            else:
+                frame = cam.fb_dump(self.alloc)
+                if frame is not None:
+                    if self._next is None:
+                        # a JPEG frame is not decoded into the slot
+                        self.alloc(frame[0], frame[1])
+                    self.commit(frame[2], cam.frame_time)
+            if frame is None:
+                time.sleep(0.001)
+
+    def close(self):
+        super(FramePublisher, self).close()
+        self.shm.unlink()
+
+
+class FrameSubscriber(SharedRing):
+    # the frames of a FramePublisher, latest() and frames() give
+    # (seq, timestamp, image) where image is a numpy view of the shared
+    # memory. It stays valid for slots - 1 more frames, valid(seq) tells
+    # whether it was overwritten while in use. No image may be kept when
+    # the subscriber is closed.
+    def __init__(self, name=SHM_NAME):
+        super(FrameSubscriber, self).__init__(attach(name))
+        self.dropped = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get(self, seq):
+        begin, end, width, height, channels, timestamp = self.header(seq)
+        if not seq or begin != seq or end != seq:
+            return None
+        return seq, timestamp, self.view(seq, width, height, channels)
+
+    def latest(self):
+        return self.get(self.head)
+
+    def wait(self, seq=0, timeout=None, interval=0.001):
+        # the first frame newer than seq, None on timeout
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            head = self.head
+            if head > seq:
+                frame = self.get(head)
+                if frame is not None:
+                    if seq:
+                        self.dropped += head - seq - 1
+                    return frame
+            if deadline is not None and time.time() > deadline:
+                return None
+            time.sleep(interval)
+
+    def frames(self, timeout=None):
+        seq = 0
+        while True:
+            frame = self.wait(seq, timeout)
+            if frame is None:
+                return
+            seq = frame[0]
+            yield frame
+
+    def __iter__(self):
+        return self.frames()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--name', default=SHM_NAME, help='shared memory name')
+    parser.add_argument('-s', '--slots', type=int, default=4, help='frames in the ring')
+    parser.add_argument('-g', '--gray', action='store_true', default=False, help='publish grayscale frames')
+    parser.add_argument('-f', '--file', help='script file')
+    args = parser.parse_args()
+
+    cam = OpenMV()
+    if not cam.connect():
+        exit()
+    cam.stop_script()
+    cam.fb_enable(True)
+    cam.exec_script(open(args.file, 'r').read() if args.file else hello_world)
+
+    # the ring is made for the size of the first frame
+    size = cam.fb_size
+    while not size[0]:
+        time.sleep(0.01)
+        size = cam.fb_size
+    pub = FramePublisher(size[0], size[1], 1 if args.gray else 3, args.slots, args.name)
+    print('publishing {}x{} frames on shared memory: {}'.format(size[0], size[1], pub.name))
+    stop = threading.Event()
+    try:
+        pub.capture(cam, stop)
+    except KeyboardInterrupt:
+        pass
+    pub.close()
+    cam.stop_script()
+    cam.disconnect()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+import asyncio
+import warnings
+
+from stm32tool.console import ScriptConsole
+
+
+class Output(object):
+    # tx_buf_len and tx_buf of a camera printing text
+    def __init__(self, text):
+        self.tx = bytearray(text)
+
+    def tx_buf_len(self):
+        return len(self.tx)
+
+    def tx_buf(self, num):
+        data = bytes(self.tx[:num])
+        del self.tx[:num]
+        return data
+
+
+def test_lines():
+    with ScriptConsole(Output(b'one\r\ntwo\nthree')) as console:
+        assert console.get(timeout=2) == 'one'
+        assert console.get(timeout=2) == 'two'
+    assert console.get(timeout=0) == 'three'
+
+
+def test_stream():
+    async def read():
+        console = ScriptConsole(Output(b'hello\nworld\n'))
+        reader = console.stream()
+        console.start()
+        lines = [await reader.readline(), await reader.readline()]
+        await asyncio.get_running_loop().run_in_executor(None, console.stop)
+        return lines + [await reader.read()]
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', DeprecationWarning)
+        assert asyncio.run(read()) == [b'hello\n', b'world\n', b'']
@@ -0,0 +1,78 @@
+import io
+import struct
+
+from stm32tool import firmware
+
+
+def hexline(rtype, offset, payload):
+    record = bytes([len(payload), offset >> 8, offset & 0xFF, rtype]) + payload
+    return ':' + (record + bytes([-sum(record) & 0xFF])).hex().upper()
+
+
+def test_load_hex():
+    lines = [
+        hexline(0x04, 0, b'\x08\x00'),
+        hexline(0x00, 0xFFF8, bytes(range(8))),
+        # extended linear address, the next 64 KB
+        hexline(0x04, 0, b'\x08\x01'),
+        hexline(0x00, 0x0000, bytes(range(8, 16))),
+        # extended segment address, 0x1000 << 4
+        hexline(0x02, 0, b'\x10\x00'),
+        hexline(0x00, 0x0010, b'\xAA\xBB'),
+        hexline(0x01, 0, b''),
+        hexline(0x00, 0x0020, b'\xCC'),
+    ]
+    fw = firmware.load(io.BytesIO('\n'.join(lines).encode()))
+    assert fw.segments == [(0x10010, b'\xAA\xBB'), (0x0800FFF8, bytes(range(16)))]
+
+
+def test_hex_later_record_wins():
+    lines = [hexline(0x00, 0, b'\x01\x02\x03\x04'), hexline(0x00, 2, b'\x05'), hexline(0x01, 0, b'')]
+    fw = firmware.load_hex('\n'.join(lines).encode())
+    assert fw.segments == [(0, b'\x01\x02\x05\x04')]
+
+
+def elf32(segments):
+    # (type, vaddr, paddr, data, memsz) program headers of a little endian ELF32
+    phoff = 52
+    offset = phoff + 32 * len(segments)
+    headers, payload = b'', b''
+    for ptype, vaddr, paddr, data, memsz in segments:
+        headers += struct.pack('<8I', ptype, offset + len(payload), vaddr, paddr, len(data), memsz, 5, 4)
+        payload += data
+    ident = b'\x7fELF\x01\x01\x01' + bytes(9)
+    head = ident + struct.pack('<HHIIIIIHHHHHH', 2, 40, 1, 0x08000000, phoff, 0, 0, 52, 32,
+                               len(segments), 40, 0, 0)
+    return head + headers + payload
+
+
+def test_load_elf():
+    data = elf32([
+        (firmware.PT_LOAD, 0x08000000, 0x08000000, b'\x11' * 8, 8),
+        # .data runs at 0x20000000 and is loaded after the text
+        (firmware.PT_LOAD, 0x20000000, 0x08000008, b'\x22' * 4, 4),
+        # .bss, nothing in the file
+        (firmware.PT_LOAD, 0x20000004, 0x20000004, b'', 16),
+        (4, 0, 0, b'\x33' * 4, 4),
+    ])
+    fw = firmware.load(io.BytesIO(data))
+    assert fw.segments == [(0x08000000, b'\x11' * 8 + b'\x22' * 4)]
+
+
+def dfuse(targets):
+    # targets: list of [(address, data)] elements
+    body = b''
+    for alt, elements in enumerate(targets):
+        image = b''.join(struct.pack('<2I', addr, len(data)) + data for addr, data in elements)
+        body += struct.pack('<6sBI255s2I', b'Target', alt, 1, b'ST...', len(image), len(elements)) + image
+    head = struct.pack('<5sBIB', b'DfuSe', 1, 11 + len(body), len(targets))
+    return head + body + bytes(16)
+
+
+def test_load_dfu():
+    data = dfuse([
+        [(0x08000000, b'\x01' * 8), (0x08004000, b'\x02' * 4)],
+        [(0x08000008, b'\x03' * 4)],
+    ])
+    fw = firmware.load(io.BytesIO(data))
+    assert fw.segments == [(0x08000000, b'\x01' * 8 + b'\x03' * 4), (0x08004000, b'\x02' * 4)]
@@ -0,0 +1,30 @@
+import threading
+import time
+
+from stm32tool.frameserver import FrameHub
+
+
+class SlowFrame(object):
+    def __init__(self):
+        self.encodes = 0
+
+    def jpeg(self, quality=90):
+        self.encodes += 1
+        time.sleep(0.05)
+        return b'jpeg'
+
+
+def test_encode_once_for_all_clients():
+    hub = FrameHub()
+    got = []
+    clients = [threading.Thread(target=lambda: got.append(hub.wait(0, timeout=5))) for _ in range(8)]
+    for client in clients:
+        client.start()
+    time.sleep(0.1)
+    frame = SlowFrame()
+    hub.publish(frame)
+    for client in clients:
+        client.join()
+    assert got == [(1, b'jpeg')] * 8
+    assert frame.encodes == 1
+    assert hub.sent == 8
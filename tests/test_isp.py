@@ -0,0 +1,161 @@
+import builtins
+import os
+import time
+
+import pytest
+
+from stm32tool import firmware, isp
+from stm32tool.fastload import FastLoader
+from stm32tool.fleet import flash_board
+from stm32tool.isp import READM, WRITEM, Isp, IspError, Journal, autobaud, discover, image_digest
+from stm32tool.ispemu import IspEmulator
+
+
+@pytest.fixture
+def emu():
+    with IspEmulator(0x413) as emu:
+        yield emu
+
+
+def test_sync_twice(emu):
+    board = Isp(emu.port, 115200, timeout=0.2, parity=emu.parity)
+    assert board.sync()
+    # synced already, as after discover()
+    assert board.sync()
+    board.getCmd()
+    board.getId()
+    assert board.id == 0x413
+    board.dev.close()
+
+
+def test_init_after_discover(emu):
+    assert discover([emu.port], parity=emu.parity)
+    start = time.time()
+    board = Isp(emu.port, 115200, timeout=5, parity=emu.parity)
+    board.init(synced=True)
+    assert time.time() - start < 1
+    assert board.id == 0x413 and board.dev.timeout == 5
+    board.dev.close()
+
+
+def test_read_write(emu):
+    board = Isp(emu.port, 115200, timeout=1, parity=emu.parity)
+    assert board.sync()
+    board.getCmd()
+    board.getVer()
+    board.getId()
+    assert board.version == hex(emu.version)
+    board.settimeout(2)
+    board.writemem(bytes(range(256)), 0x08000100)
+    assert board.readmem(0x08000100, 256) == bytes(range(256))
+    assert emu.flash[0x100:0x200] == bytes(range(256))
+    board.dev.close()
+
+
+def test_flash_after_discover(emu):
+    assert [boot.port for boot in discover([emu.port], parity=emu.parity)] == [emu.port]
+    image = firmware.load_bin(bytes(range(256)) * 4, 0x08000000)
+    result = flash_board(emu.port, image, bps=115200, go=False, parity=emu.parity)
+    assert result['ok'], result.get('error')
+    assert emu.flash[:1024] == bytes(range(256)) * 4
+
+
+def init(emu):
+    board = Isp(emu.port, 115200, timeout=1, parity=emu.parity)
+    board.verbose = False
+    board.init()
+    return board
+
+
+def test_erase_out_of_flash(emu):
+    board = init(emu)
+    image = firmware.load_bin(b'\x00' * 16, 0x08000000 + emu.chip.flash)
+    with pytest.raises(Exception, match='out of flash'):
+        board.eraseimage(image)
+    board.dev.close()
+
+
+def test_delta_legacy_erase():
+    with IspEmulator(0x430, extended=False) as emu:
+        board = init(emu)
+        # page 256 and up can not be erased by legacy erase
+        image = firmware.load_bin(b'\x00' * 16, 0x08000000 + 256 * 0x800)
+        with pytest.raises(IspError, match='legacy erase'):
+            board.writedelta(image)
+        assert not emu.stats.get(READM)
+        board.dev.close()
+
+
+def test_fast_loader(emu):
+    board = init(emu)
+    fast = FastLoader(board, b'\x00' * 64)
+    fast.start(230400)
+    image = firmware.load_bin(bytes(range(256)) * 64, 0x08000000)
+    fast.erase(board.imagesectors(image))
+    fast.writeimage(image, progress=False)
+    fast.verify(image)
+    assert emu.flash[:0x4000] == bytes(range(256)) * 64
+    board.dev.close()
+
+
+def test_fast_loader_bad_bps(emu):
+    board = init(emu)
+    with pytest.raises(IspError, match='-1 bps'):
+        FastLoader(board, b'\x00' * 64).start(-1)
+    board.dev.close()
+
+
+@pytest.fixture
+def nobaud(monkeypatch, tmp_path):
+    monkeypatch.setattr(isp, 'BAUD_CACHE', str(tmp_path / 'baud.json'))
+    monkeypatch.setattr(isp, 'PROBE_TIMEOUT', 0.05)
+
+
+def test_autobaud_reset_line(monkeypatch, nobaud):
+    # 460800 locks the bootloader on a wrong rate, 230400 works
+    with IspEmulator(0x413, max_bps=230400) as emu:
+        monkeypatch.setattr(Isp, 'reset_board', lambda self, line=None: emu.reset())
+        board = autobaud(emu.port, 'dtr', parity=emu.parity)
+        assert board is not None
+        assert board.dev.baudrate == 230400 and board.dev.timeout == 5
+        assert isp.load_baud(emu.port) == 230400
+        board.dev.close()
+
+
+def test_autobaud_without_reset_line(monkeypatch, nobaud):
+    with IspEmulator(0x413, max_bps=230400) as emu:
+        prompts = []
+        monkeypatch.setattr(builtins, 'input', lambda text: prompts.append(emu.reset()))
+        assert autobaud(emu.port, parity=emu.parity) is None
+    assert len(prompts) == 1
+
+
+def test_retry_nacks():
+    with IspEmulator(0x413, nack_rate=0.1, seed=1) as emu:
+        board = init(emu)
+        board.retries = 10
+        data = bytes(range(256)) * 32
+        board.writeimage(firmware.load_bin(data, 0x08000000), progress=False)
+        assert board.readbuf(0x08000000, len(data), progress=False) == data
+        assert board.retried
+        assert emu.flash[:len(data)] == data
+        board.dev.close()
+
+
+def test_journal_resume(emu, tmp_path):
+    path = str(tmp_path / 'journal')
+    data = bytes(range(256)) * 4
+    image = firmware.load_bin(data, 0x08000000)
+    # an interrupted session wrote the first two blocks
+    with open(path, 'w') as f:
+        f.write('{}\n08000000\n08000100\n'.format(image_digest(image)))
+    emu.flash[:0x200] = data[:0x200]
+
+    board = init(emu)
+    journal = Journal(path, image)
+    assert len(journal) == 2
+    board.writeimage(image, progress=False, journal=journal)
+    assert emu.stats[WRITEM] == 2
+    assert emu.flash[:len(data)] == data
+    assert not os.path.exists(path)
+    board.dev.close()
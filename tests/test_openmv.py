@@ -0,0 +1,148 @@
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+from stm32tool.openmv import FB_GRAY, FB_JPEG, FB_RGB565, OpenMV, decode_rgb565
+from stm32tool.openmvemu import OpenMVEmulator
+from stm32tool.openmvpool import OpenMVPool
+
+
+def rgb565(r, g, b):
+    return (((r >> 3) << 11) | ((g >> 2) << 5) | (b >> 3)).to_bytes(2, 'big')
+
+
+def test_decode_rgb565():
+    buff = rgb565(255, 0, 0) + rgb565(0, 255, 0) + rgb565(0, 0, 255) + rgb565(255, 255, 255)
+    out = np.empty((2, 2, 3), dtype=np.uint8)
+    decode_rgb565(buff, out)
+    assert out.reshape(-1, 3).tolist() == [[255, 0, 0], [0, 255, 0], [0, 0, 255], [255, 255, 255]]
+
+
+def test_decode_rgb565_allocation():
+    buff = bytes(range(256)) * 600
+    out = np.empty((240, 320, 3), dtype=np.uint8)
+    decode_rgb565(buff, out)
+    tracemalloc.start()
+    try:
+        decode_rgb565(buff, out)
+        size, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    # a QVGA frame is 150 KB of pixels and 450 KB decoded
+    assert peak < 4096
+
+
+def test_decode_errors():
+    cam = OpenMV(port='none')
+    # a JPEG frame of 320x240 whose payload is not a JPEG
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        frames = list(pool.map(lambda _: cam.decode((320, 240, 64), bytes(64)), range(200)))
+    assert frames == [None] * 200
+    assert cam.decode_errors == 200
+    assert cam.decode_error.startswith('JPEG decode error')
+
+
+def wait_frames(stats, count, timeout=5):
+    deadline = time.time() + timeout
+    while stats.frames < count and time.time() < deadline:
+        time.sleep(0.01)
+    assert stats.frames >= count
+
+
+def test_pool_latest():
+    with OpenMVEmulator(64, 48, fps=100, running=True) as emu:
+        pool = OpenMVPool()
+        cam = OpenMV(port=emu.port)
+        assert cam.connect()
+        pool.cams['emu'] = cam
+        pool.start()
+        try:
+            wait_frames(pool.stats['emu'], 1)
+            w, h, image = pool.latest('emu')
+            kept = image.copy()
+            wait_frames(pool.stats['emu'], pool.stats['emu'].frames + 5)
+            assert (w, h) == (64, 48)
+            assert (image == kept).all()
+        finally:
+            pool.close()
+
+
+def dump(cam, lazy=False, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        frame = cam.fb_dump(lazy=lazy)
+        if frame is not None:
+            return frame
+    raise AssertionError('no frame')
+
+
+def test_emulator_control():
+    with OpenMVEmulator(64, 48, fps=0) as emu:
+        cam = OpenMV(port=emu.port)
+        assert cam.connect()
+        assert cam.fw_version == '4.1.2'
+        assert cam.arch_id == emu.arch
+        assert cam.fb_size == (0, 0, 0)
+        cam.exec_script('print(1)')
+        assert cam.arch_id
+        assert emu.running and emu.script == 'print(1)'
+        dump(cam)
+        assert cam.tx_buf(cam.tx_buf_len())
+        cam.stop_script()
+        cam.reset()
+        # commands are served in order, the reset cleared the output
+        assert cam.tx_buf_len() == 0
+        assert emu.resets == 1 and not emu.running
+        cam.disconnect()
+
+
+@pytest.mark.parametrize('format', [FB_GRAY, FB_RGB565, FB_JPEG])
+def test_emulator_frames(format):
+    with OpenMVEmulator(64, 48, format, fps=0, running=True) as emu:
+        cam = OpenMV(port=emu.port)
+        assert cam.connect()
+        w, h, image = dump(cam)
+        assert (w, h, image.shape) == (64, 48, (48, 64, 3))
+        frame = dump(cam, lazy=True)
+        assert frame.format == format
+        assert frame.tobytes() == emu.frames[1]
+        cam.disconnect()
+
+
+def test_emulator_bootloader():
+    with OpenMVEmulator() as emu:
+        cam = OpenMV(port=emu.port)
+        assert cam.connect()
+        assert cam.bootloader_start()
+        assert cam.bootloader_flash() == (0, 1, 15)
+        cam.flash_erase(1)
+        cam.flash_write(bytes(range(60)))
+        time.sleep(0.1)
+        cam.flash_write(bytes(range(60, 80)))
+        time.sleep(0.1)
+        cam.bootloader_reset()
+        time.sleep(0.1)
+        assert emu.erased == [1]
+        assert emu.image == bytes(range(80))
+        assert emu.resets == 1
+        cam.disconnect()
+
+
+def test_stream_interrupted():
+    with OpenMVEmulator(32, 24, fps=0, running=True) as emu:
+        cam = OpenMV(port=emu.port)
+        assert cam.connect()
+        stream = cam.fb_stream(lazy=True)
+        frames = [next(stream) for _ in range(3)]
+        # a command while a frame size query of the stream is in flight
+        assert cam.tx_buf_len() >= 0
+        frames.append(next(stream))
+        stream.close()
+        # the camera is not left holding a frame
+        frames.append(dump(cam, lazy=True))
+        frames.append(dump(cam, lazy=True))
+        assert [frame.tobytes() for frame in frames] == emu.frames[:6]
+        cam.disconnect()
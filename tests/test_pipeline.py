@@ -0,0 +1,44 @@
+import itertools
+import threading
+import time
+
+from stm32tool.openmv import OpenMV
+from stm32tool.openmvemu import OpenMVEmulator
+from stm32tool.pipeline import Pipeline
+
+
+def slow(value):
+    time.sleep(0.3)
+    return value
+
+
+def test_pipeline_order():
+    with Pipeline(range(20), queue_size=2).add(lambda value: value * 2, workers=4) as pipe:
+        assert list(pipe) == [value * 2 for value in range(20)]
+
+
+def test_stop_slow_stage():
+    pipe = Pipeline(itertools.count(), queue_size=2).add(slow).add(slow)
+    pipe.start()
+    assert pipe.get(timeout=5) is not None
+    stopper = threading.Thread(target=pipe.stop, daemon=True)
+    start = time.time()
+    stopper.start()
+    stopper.join(5)
+    assert not stopper.is_alive()
+    assert time.time() - start < 2
+
+
+def test_decoded_frames_are_kept():
+    with OpenMVEmulator(32, 24, fps=0, running=True) as emu:
+        cam = OpenMV(port=emu.port)
+        assert cam.connect()
+        pipe = Pipeline(cam, queue_size=4, lazy=False).add(lambda frame: time.sleep(0.01) or frame)
+        pipe.start()
+        results = [pipe.get(timeout=5)[1] for _ in range(12)]
+        pipe.stop()
+        cam.disconnect()
+    assert len(set(id(image) for _, _, image in results)) == 12
+    # the emulator sends 8 different frames in turn
+    assert not (results[0][2] == results[1][2]).all()
+    assert (results[0][2] == results[8][2]).all()
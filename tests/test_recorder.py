@@ -0,0 +1,38 @@
+import threading
+
+from stm32tool.openmv import FB_GRAY, Frame
+from stm32tool.recorder import Recorder, Replay
+
+
+def test_record_replay(tmp_path):
+    path = str(tmp_path / 'rec.omv')
+    with Recorder(path, {'arch': 'test'}) as rec:
+        for i in range(3):
+            rec.add(Frame(4, 2, FB_GRAY, bytes([i]) * 8, timestamp=i))
+    assert rec.frames == 3
+    cam = Replay(path)
+    assert cam.connect()
+    assert cam.arch_id == 'test'
+    frames = [cam.fb_dump(lazy=True) for _ in range(3)]
+    assert [frame.tobytes() for frame in frames] == [bytes([i]) * 8 for i in range(3)]
+    assert cam.fb_dump(lazy=True) is None
+    cam.disconnect()
+
+
+def test_close_after_writer_died(tmp_path):
+    rec = Recorder(str(tmp_path / 'rec.omv'), queue_size=1)
+    # not a frame, the writer dies on it and the queue fills up
+    for _ in range(3):
+        rec.add(object())
+    errors = []
+
+    def close():
+        try:
+            rec.close()
+        except AttributeError as e:
+            errors.append(e)
+    closer = threading.Thread(target=close, daemon=True)
+    closer.start()
+    closer.join(5)
+    assert not closer.is_alive()
+    assert errors